@@ -0,0 +1,336 @@
+#!/usr/bin/env python3 -W all
+
+""" Benchmark projectionist.py against the simulator
+
+Starts the MQTT broker stand-in and a simulated TK850, runs
+projectionist.py against them with a throwaway copy of config.yaml, and
+measures from the outside, the way Home Assistant sees it:
+
+    latency      /set published -> matching state published back
+    throughput   closed-loop /set -> state round trips per second
+    queue depth  commands not yet on the serial line, and replies not
+                 yet out on MQTT, sampled during the throughput run
+
+Both queue depths are estimated from counters on either side of the
+daemon (the benchmark's own, the simulator's and the broker's), so they
+include the odd status poll and are an upper bound rather than exact.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+import yaml
+
+from mqtt_broker import Broker
+from tk850_simulator import TK850Simulator
+
+VERSION = '0.1.0'
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PROJECTIONIST = os.path.join(HERE, '..', 'projectionist.py')
+CONFIG = os.path.join(HERE, '..', 'config.yaml')
+
+# Numeric settings the throughput run cycles through, each with a range
+# of values it can step around in
+THROUGHPUT_ATTRIBUTES = {
+    'brightness': range(40, 60),
+    'contrast': range(40, 60),
+    'color': range(40, 60),
+    'sharpness': range(1, 15),
+}
+
+
+class StateWatcher:
+    """ Follows <topic base>/<attribute> on the broker """
+
+    def __init__(self, port, base):
+        self.base = base
+        self.state = {}
+        self.messages = 0
+        self.condition = threading.Condition()
+        self.client = mqtt.Client(client_id='projectionist-bench')
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.on_message
+        self.client.connect('127.0.0.1', port)
+        self.client.loop_start()
+
+    def on_connect(self, client, userdata, flags, rc):
+        client.subscribe(self.base + '/+')
+
+    def on_message(self, client, userdata, msg):
+        attribute = msg.topic[len(self.base) + 1:]
+        with self.condition:
+            self.messages += 1
+            self.state[attribute] = msg.payload.decode()
+            self.condition.notify_all()
+
+    def set(self, attribute, payload):
+        self.client.publish(f'{self.base}/{attribute}/set', payload)
+
+    def wait_for(self, attribute, value=None, timeout=10.0):
+        """ Wait until attribute has a value (that value, if given) """
+
+        def ready():
+            current = self.state.get(attribute)
+            return current is not None and value in (None, current)
+
+        with self.condition:
+            return self.condition.wait_for(ready, timeout=timeout)
+
+    def stop(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+def write_config(args, simulator, broker):
+    """ A copy of config.yaml pointed at the simulator and broker """
+
+    with open(CONFIG) as f:
+        config = yaml.safe_load(f)
+
+    config['serial_port']['name'] = simulator.path
+    config['serial_port']['baud'] = args.baud
+    config['mqtt'].update(hostname=broker.host, portnumber=broker.port,
+                          username=None, password=None, useTLS=False)
+    config['mqtt']['topic'].update(node_id='bench', object_id='tk850')
+    config['worker']['mode'] = args.mode
+    config.pop('devices', None)
+
+    # Stay off the ports and socket a running projectionist may have
+    config['metrics']['port'] = 0
+    config['api'] = {'port': 0}
+    config['multiplexer'] = {'path': None}
+
+    # ... and off its state file and flight recorder dumps
+    config['worker']['state_file'] = None
+    config['flight_recorder']['path'] = None
+
+    f = tempfile.NamedTemporaryFile('w', suffix='.yaml', delete=False)
+    with f:
+        yaml.safe_dump(config, f)
+    return f.name, (f"{config['mqtt']['topic']['prefix']}/bench/"
+                    f"{config['mqtt']['topic']['object_id']}")
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(samples):
+    """ min/median/p95/max of a list of seconds, in milliseconds """
+
+    if not samples:
+        return {'count': 0}
+    return {
+        'count': len(samples),
+        'min_ms': round(1000 * min(samples), 1),
+        'median_ms': round(1000 * statistics.median(samples), 1),
+        'p95_ms': round(1000 * percentile(samples, 0.95), 1),
+        'max_ms': round(1000 * max(samples), 1),
+    }
+
+
+def measure_latency(watcher, count, timeout):
+    """ Toggle blank and time how long each new state takes to come back """
+
+    samples = []
+    failures = 0
+    for _ in range(count):
+        target = 'OFF' if watcher.state.get('blank') == 'ON' else 'ON'
+        started = time.monotonic()
+        watcher.set('blank', target)
+        if watcher.wait_for('blank', target, timeout=timeout):
+            samples.append(time.monotonic() - started)
+        else:
+            failures += 1
+    return dict(summarize(samples), failures=failures)
+
+
+def measure_throughput(watcher, simulator, broker, duration, timeout):
+    """ Keep one /set outstanding per attribute for duration seconds """
+
+    attributes = list(THROUGHPUT_ATTRIBUTES)
+    expected = {}
+    sent_at = {}
+    step = {attribute: 0 for attribute in attributes}
+    samples = []
+    sent = 0
+    depths = {'serial': [], 'publish': []}
+
+    frames_base = simulator.frames_received
+    replies_base = simulator.frames_sent
+    published_base = watcher.messages
+
+    def send(attribute):
+        nonlocal sent
+        values = THROUGHPUT_ATTRIBUTES[attribute]
+        # Every value differs from the last, so every reply is a change
+        # and gets published
+        step[attribute] += 1
+        value = str(values[step[attribute] % len(values)])
+        if value == watcher.state.get(attribute):
+            step[attribute] += 1
+            value = str(values[step[attribute] % len(values)])
+        expected[attribute] = value
+        sent_at[attribute] = time.monotonic()
+        sent += 1
+        watcher.set(attribute, value)
+
+    started = time.monotonic()
+    for attribute in attributes:
+        send(attribute)
+
+    completed = 0
+    next_sample = started
+    while time.monotonic() - started < duration:
+        with watcher.condition:
+            watcher.condition.wait(timeout=0.05)
+            done = [attribute for attribute in attributes
+                    if watcher.state.get(attribute) == expected[attribute]]
+        now = time.monotonic()
+        for attribute in done:
+            samples.append(now - sent_at[attribute])
+            completed += 1
+            send(attribute)
+        for attribute in attributes:
+            if now - sent_at[attribute] > timeout:
+                send(attribute)
+
+        if now >= next_sample:
+            next_sample = now + 0.1
+            depths['serial'].append(
+                max(0, sent - (simulator.frames_received - frames_base)))
+            depths['publish'].append(
+                max(0, (simulator.frames_sent - replies_base) -
+                    (watcher.messages - published_base)))
+
+    elapsed = time.monotonic() - started
+    return {
+        'commands': completed,
+        'seconds': round(elapsed, 2),
+        'commands_per_second': round(completed / elapsed, 2),
+        'round_trip': summarize(samples),
+        'serial_queue_depth': {
+            'mean': round(statistics.mean(depths['serial']), 2),
+            'max': max(depths['serial'])},
+        'publish_queue_depth': {
+            'mean': round(statistics.mean(depths['publish']), 2),
+            'max': max(depths['publish'])},
+        'broker_messages': broker.messages_in,
+    }
+
+
+def print_report(results):
+    print(f"projectionist benchmark ({results['mode']} mode, "
+          f"{results['baud']} baud, {results['latency_ms']}ms device latency)")
+    print()
+    print(f"{'':24}{'count':>7}{'min':>9}{'median':>9}{'p95':>9}{'max':>9}")
+    for name, summary in (
+            ('command -> state', results['latency']),
+            ('throughput round trip', results['throughput']['round_trip'])):
+        if not summary.get('count'):
+            print(f'{name:24}{0:>7}')
+            continue
+        print(f"{name:24}{summary['count']:>7}"
+              f"{summary['min_ms']:>9}{summary['median_ms']:>9}"
+              f"{summary['p95_ms']:>9}{summary['max_ms']:>9}  ms")
+    print()
+    throughput = results['throughput']
+    print(f"throughput:          {throughput['commands_per_second']} commands/s"
+          f" ({throughput['commands']} in {throughput['seconds']}s)")
+    print(f"serial queue depth:  mean {throughput['serial_queue_depth']['mean']}"
+          f", max {throughput['serial_queue_depth']['max']}")
+    print(f"publish queue depth: mean {throughput['publish_queue_depth']['mean']}"
+          f", max {throughput['publish_queue_depth']['max']}")
+    if results['latency'].get('failures'):
+        print(f"timed out:           {results['latency']['failures']} commands")
+
+
+def parse_cli_arguments():
+    """ Parse command-line arguments """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--mode", choices=['threaded', 'asyncio'], default='threaded',
+        help='worker mode to run projectionist in (default: threaded)')
+    parser.add_argument(
+        "--baud", type=int, default=9600,
+        help='simulated line speed (default: 9600)')
+    parser.add_argument(
+        "--latency", type=float, default=0.02,
+        help='simulated projector thinking time, seconds (default: 0.02)')
+    parser.add_argument(
+        "--cr-echo", action="store_true",
+        help='end echoes with CR only, as the projector does')
+    parser.add_argument(
+        "--count", type=int, default=50,
+        help='number of command -> state round trips to time (default: 50)')
+    parser.add_argument(
+        "--duration", type=float, default=10.0,
+        help='seconds to run the throughput test for (default: 10)')
+    parser.add_argument(
+        "--timeout", type=float, default=10.0,
+        help='give up on a command after this many seconds (default: 10)')
+    parser.add_argument(
+        "--json", action="store_true",
+        help='print the results as JSON')
+    parser.add_argument(
+        "-v", "--verbose", action="store_true",
+        help="show projectionist's output")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_cli_arguments()
+
+    broker = Broker().start()
+    simulator = TK850Simulator(
+        baud=args.baud, latency=args.latency, warmup=0.5, cooldown=0.5,
+        power='ON', cr_echo=args.cr_echo).start()
+    config_file, base = write_config(args, simulator, broker)
+
+    watcher = StateWatcher(broker.port, base)
+    command = [sys.executable, PROJECTIONIST, '-f', config_file]
+    if args.verbose:
+        command.append('-v')
+    daemon = subprocess.Popen(
+        command, cwd=os.path.dirname(PROJECTIONIST),
+        stdout=None if args.verbose else subprocess.DEVNULL,
+        stderr=None if args.verbose else subprocess.DEVNULL)
+
+    try:
+        if not (watcher.wait_for('power', timeout=args.timeout) and
+                watcher.wait_for('blank', timeout=args.timeout)):
+            sys.exit('projectionist never published any state')
+
+        results = {
+            'mode': args.mode,
+            'baud': args.baud,
+            'latency_ms': round(1000 * args.latency, 1),
+            'latency': measure_latency(watcher, args.count, args.timeout),
+            'throughput': measure_throughput(
+                watcher, simulator, broker, args.duration, args.timeout),
+        }
+    finally:
+        daemon.terminate()
+        daemon.wait(timeout=10)
+        watcher.stop()
+        os.unlink(config_file)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results)
+
+
+if __name__ == "__main__":
+    main()
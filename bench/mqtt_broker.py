@@ -0,0 +1,311 @@
+#!/usr/bin/env python3 -W all
+
+""" Just enough of an MQTT 3.1.1 (and 5) broker to test against
+
+Handles CONNECT, PUBLISH (QoS 0, 1 and 2 inbound; everything is
+delivered onwards at QoS 0), SUBSCRIBE/UNSUBSCRIBE with "+" and "#"
+wildcards, retained messages, wills, PINGREQ and DISCONNECT.  MQTT 5
+clients get their publish properties (response topic, correlation data
+and so on) passed along to other MQTT 5 clients untouched.  There's no
+authentication, persistence or session state: it's a stand-in for
+test.mosquitto.org on the loopback interface, not a broker to deploy.
+"""
+
+import argparse
+import socket
+import struct
+import threading
+
+VERSION = '0.1.0'
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP, SUBSCRIBE, \
+    SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = \
+    range(1, 15)
+
+
+def topic_matches(topic_filter, topic):
+    """ Does a topic match a subscription filter with wildcards? """
+
+    filter_levels = topic_filter.split('/')
+    topic_levels = topic.split('/')
+    for index, level in enumerate(filter_levels):
+        if level == '#':
+            return True
+        if index >= len(topic_levels):
+            return False
+        if level != '+' and level != topic_levels[index]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+def encode_length(length):
+    """ MQTT's variable-length "remaining length" encoding """
+
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | (0x80 if length else 0))
+        if not length:
+            return bytes(encoded)
+
+
+def encode_string(text):
+    data = text.encode('utf-8') if isinstance(text, str) else text
+    return struct.pack('!H', len(data)) + data
+
+
+def decode_string(data, offset):
+    length, = struct.unpack_from('!H', data, offset)
+    return data[offset + 2:offset + 2 + length], offset + 2 + length
+
+
+def decode_length(data, offset):
+    """ A variable-length integer, as used for MQTT 5 property lengths """
+
+    length, multiplier = 0, 1
+    while True:
+        byte = data[offset]
+        offset += 1
+        length += (byte & 0x7f) * multiplier
+        multiplier *= 128
+        if not byte & 0x80:
+            return length, offset
+
+
+def skip_properties(data, offset):
+    """ Return an MQTT 5 property block and the offset after it """
+
+    length, start = decode_length(data, offset)
+    return data[offset:start + length], start + length
+
+
+class Session:
+    """ One connected client """
+
+    def __init__(self, broker, sock):
+        self.broker = broker
+        self.sock = sock
+        self.client_id = None
+        self.subscriptions = set()
+        self.will = None
+        self.version = 4
+        self.send_lock = threading.Lock()
+
+    def send(self, packet_type, flags, body):
+        with self.send_lock:
+            try:
+                self.sock.sendall(bytes([packet_type << 4 | flags]) +
+                                  encode_length(len(body)) + body)
+            except OSError:
+                pass
+
+    def deliver(self, topic, payload, retain=False, properties=b'\x00'):
+        body = encode_string(topic)
+        if self.version == 5:
+            body += properties
+        self.send(PUBLISH, 1 if retain else 0, body + payload)
+
+    def ack(self, packet_type, packet_id, reasons=b''):
+        """ PUBACK, SUBACK and friends, with an empty MQTT 5 property block """
+
+        properties = b'\x00' if self.version == 5 else b''
+        if packet_type in (PUBACK, PUBREC, PUBCOMP):
+            properties = b''
+        self.send(packet_type, 0, packet_id + properties + reasons)
+
+    def read_exactly(self, count):
+        data = b''
+        while len(data) < count:
+            chunk = self.sock.recv(count - len(data))
+            if not chunk:
+                raise ConnectionError('client went away')
+            data += chunk
+        return data
+
+    def read_packet(self):
+        header = self.read_exactly(1)[0]
+        length, multiplier = 0, 1
+        while True:
+            byte = self.read_exactly(1)[0]
+            length += (byte & 0x7f) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return header >> 4, header & 0x0f, self.read_exactly(length)
+
+    def handle_connect(self, body):
+        _, offset = decode_string(body, 0)
+        self.version = body[offset]
+        flags = body[offset + 1]
+        offset += 4
+        if self.version == 5:
+            _, offset = skip_properties(body, offset)
+        client_id, offset = decode_string(body, offset)
+        self.client_id = client_id.decode('utf-8', errors='replace')
+        if flags & 0x04:
+            will_properties = b'\x00'
+            if self.version == 5:
+                will_properties, offset = skip_properties(body, offset)
+            will_topic, offset = decode_string(body, offset)
+            will_payload, offset = decode_string(body, offset)
+            self.will = (will_topic.decode('utf-8'), will_payload,
+                         bool(flags & 0x20), will_properties)
+        self.send(CONNACK, 0,
+                  b'\x00\x00\x00' if self.version == 5 else b'\x00\x00')
+
+    def handle_publish(self, flags, body):
+        qos = (flags >> 1) & 0x03
+        topic, offset = decode_string(body, 0)
+        if qos:
+            packet_id = body[offset:offset + 2]
+            offset += 2
+        properties = b'\x00'
+        if self.version == 5:
+            properties, offset = skip_properties(body, offset)
+        self.broker.publish(topic.decode('utf-8'), body[offset:],
+                            retain=bool(flags & 0x01), properties=properties)
+        if qos == 1:
+            self.ack(PUBACK, packet_id)
+        elif qos == 2:
+            self.ack(PUBREC, packet_id)
+
+    def handle_subscribe(self, body):
+        packet_id = body[:2]
+        offset = 2
+        if self.version == 5:
+            _, offset = skip_properties(body, offset)
+        granted = bytearray()
+        filters = []
+        while offset < len(body):
+            topic_filter, offset = decode_string(body, offset)
+            offset += 1
+            filters.append(topic_filter.decode('utf-8'))
+            granted.append(0)
+        self.subscriptions.update(filters)
+        self.ack(SUBACK, packet_id, bytes(granted))
+        for topic_filter in filters:
+            self.broker.send_retained(self, topic_filter)
+
+    def handle_unsubscribe(self, body):
+        packet_id = body[:2]
+        offset = 2
+        if self.version == 5:
+            _, offset = skip_properties(body, offset)
+        reasons = bytearray()
+        while offset < len(body):
+            topic_filter, offset = decode_string(body, offset)
+            self.subscriptions.discard(topic_filter.decode('utf-8'))
+            reasons.append(0)
+        self.ack(UNSUBACK, packet_id,
+                 bytes(reasons) if self.version == 5 else b'')
+
+    def run(self):
+        clean = False
+        try:
+            while True:
+                packet_type, flags, body = self.read_packet()
+                if packet_type == CONNECT:
+                    self.handle_connect(body)
+                elif packet_type == PUBLISH:
+                    self.handle_publish(flags, body)
+                elif packet_type == PUBREL:
+                    self.ack(PUBCOMP, body[:2])
+                elif packet_type == SUBSCRIBE:
+                    self.handle_subscribe(body)
+                elif packet_type == UNSUBSCRIBE:
+                    self.handle_unsubscribe(body)
+                elif packet_type == PINGREQ:
+                    self.send(PINGRESP, 0, b'')
+                elif packet_type == DISCONNECT:
+                    clean = True
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.broker.remove(self)
+            self.sock.close()
+            if not clean and self.will is not None:
+                self.broker.publish(*self.will)
+
+
+class Broker:
+    """ Accepts clients on a TCP port and routes messages between them """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen()
+        self.host, self.port = self.listener.getsockname()
+        self.sessions = set()
+        self.retained = {}
+        self.lock = threading.Lock()
+        self.messages_in = 0
+        self.messages_out = 0
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+    def run(self):
+        while True:
+            sock, _ = self.listener.accept()
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            session = Session(self, sock)
+            with self.lock:
+                self.sessions.add(session)
+            threading.Thread(target=session.run, daemon=True).start()
+
+    def remove(self, session):
+        with self.lock:
+            self.sessions.discard(session)
+
+    def publish(self, topic, payload, retain=False, properties=b'\x00'):
+        with self.lock:
+            self.messages_in += 1
+            if retain:
+                if payload:
+                    self.retained[topic] = (payload, properties)
+                else:
+                    self.retained.pop(topic, None)
+            sessions = list(self.sessions)
+
+        for session in sessions:
+            if any(topic_matches(topic_filter, topic)
+                   for topic_filter in list(session.subscriptions)):
+                self.messages_out += 1
+                session.deliver(topic, payload, properties=properties)
+
+    def send_retained(self, session, topic_filter):
+        with self.lock:
+            retained = [(topic, payload, properties)
+                        for topic, (payload, properties)
+                        in self.retained.items()
+                        if topic_matches(topic_filter, topic)]
+        for topic, payload, properties in retained:
+            session.deliver(topic, payload, retain=True,
+                            properties=properties)
+
+
+def parse_cli_arguments():
+    """ Parse command-line arguments """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--host", default="127.0.0.1",
+        help='address to listen on (default: 127.0.0.1)')
+    parser.add_argument(
+        "--port", type=int, default=1883,
+        help='port to listen on (default: 1883)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_cli_arguments()
+    broker = Broker(args.host, args.port)
+    print(f'{broker.host}:{broker.port}', flush=True)
+    broker.run()
+
+
+if __name__ == "__main__":
+    main()
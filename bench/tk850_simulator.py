@@ -0,0 +1,248 @@
+#!/usr/bin/env python3 -W all
+
+""" Simulated BenQ TK850 on a pseudo-terminal
+
+Speaks the projector's RS-232 protocol as captured in captures/:
+commands are echoed back with a leading ">", queries are answered with
+"*TOKEN=value#", and anything the projector won't do right now gets
+"*Block item#".  Power-on goes through a warm-up (with the odd "0.33PUN"
+frame at the start of it) and power-off through a cool-down, during
+which most commands are blocked.  Output is paced at the configured
+baud rate, so timings look like the real serial line.
+
+Run it on its own and point projectionist.py's serial_port.name at the
+path it prints, or use TK850Simulator from the benchmarks.
+"""
+
+import argparse
+import os
+import pty
+import threading
+import time
+import tty
+
+import yaml
+
+VERSION = '0.1.0'
+
+COMMAND_TABLE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'commands.yaml')
+
+# Values captured from a real projector (captures/working.txt)
+CAPTURED_STATE = {
+    'POW': 'ON', 'SOUR': 'HDMI1', 'MUTE': 'OFF', 'VOL': '0',
+    'APPMOD': 'CINE', 'CON': '43', 'BRI': '50', 'COLOR': '50',
+    'TINT': '50', 'SHARP': '6', 'CT': 'NORMAL', 'ASP': 'AUTO', 'BC': 'ON',
+    'PP': 'FT', 'DIRECTPOWER': 'OFF', 'LTIM': '1349', 'LAMPM': 'SECO',
+    'MODELNAME': 'W2700', 'BLANK': 'OFF', 'FREEZE': 'OFF', '3D': 'OFF',
+    'GAMMA': '2.2', 'HDRBRI': '-2', 'RGAIN': '98', 'GGAIN': '106',
+    'BGAIN': '101', 'ROFFSET': '252', 'GOFFSET': '260', 'BOFFSET': '262',
+    'PRIMCR': 'RED', 'HUE': '230', 'SATURATION': '200', 'GAIN': '230',
+    'DIRIS': 'OFF', 'WRGAIN': '200', 'WGGAIN': '200', 'WBGAIN': '200',
+    'MENU': 'OFF',
+}
+
+# What the projector still answers while it's in standby
+STANDBY_TOKENS = {'POW', 'MODELNAME', 'LTIM', 'DIRECTPOWER'}
+
+
+def load_tokens(filename=COMMAND_TABLE):
+    """ Return the command tokens (upper case) and bare commands we know """
+
+    with open(filename) as f:
+        commands = yaml.safe_load(f)['commands']
+
+    tokens = set()
+    bare = set()
+    for command in commands:
+        if command.get('bare'):
+            bare.update(str(value).upper()
+                        for value in command['values'].values())
+        else:
+            tokens.add(str(command['token']).upper())
+    return tokens, bare
+
+
+class TK850Simulator:
+    """ A projector on the far end of a pty """
+
+    def __init__(self, baud=9600, latency=0.02, warmup=2.0, cooldown=1.0,
+                 power='ON', cr_echo=False):
+        self.baud = baud
+        self.latency = latency
+        self.warmup = warmup
+        self.cooldown = cooldown
+        self.cr_echo = cr_echo
+        self.tokens, self.bare = load_tokens()
+        self.state = dict(CAPTURED_STATE, POW=power)
+        self.transition = None          # 'warming' or 'cooling'
+        self.transition_ends = 0
+        self.lock = threading.Lock()
+
+        # Counters, for the benchmarks
+        self.frames_received = 0
+        self.frames_sent = 0
+        self.blocked = 0
+
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.path = os.ttyname(self.slave)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def write(self, data):
+        """ Write to the line, taking as long as the baud rate says """
+
+        # 8N1 is ten bits a byte
+        time.sleep(len(data) * 10 / self.baud)
+        os.write(self.master, data)
+
+    def reply(self, text):
+        self.frames_sent += 1
+        self.write(text.encode('ascii') + b'\r\n')
+
+    def update_transition(self):
+        """ Finish warming up or cooling down once its time is up """
+
+        if self.transition and time.monotonic() >= self.transition_ends:
+            self.transition = None
+
+    def handle(self, frame):
+        """ Act on one "*...#" frame from the host """
+
+        self.frames_received += 1
+
+        # Echo the command back as it was received
+        self.write(b'>' + frame.encode('ascii') + b'#' +
+                   (b'\r' if self.cr_echo else b'\r\n'))
+        time.sleep(self.latency)
+
+        body = frame.strip().lstrip('*')
+        token, equals, value = body.partition('=')
+        token = token.strip().upper()
+        value = value.strip()
+
+        with self.lock:
+            self.update_transition()
+
+            if not equals:
+                if token not in self.bare or self.state['POW'] != 'ON':
+                    self.blocked += 1
+                    self.reply('*Block item#')
+                return
+
+            if token not in self.tokens:
+                self.reply('*Illegal format#')
+                return
+
+            if token == 'POW':
+                self.handle_power(value)
+                return
+
+            if self.transition or (self.state['POW'] != 'ON' and
+                                   token not in STANDBY_TOKENS):
+                self.blocked += 1
+                self.reply('*Block item#')
+                return
+
+            if value != '?':
+                self.set_value(token, value)
+            self.reply(f'*{token}={self.state.get(token, "0")}#')
+
+    def handle_power(self, value):
+        """ Power on/off with warm-up and cool-down """
+
+        value = value.upper()
+        if value == 'ON' and self.state['POW'] == 'OFF':
+            if self.transition == 'cooling':
+                self.blocked += 1
+                self.reply('*Block item#')
+                return
+            self.state['POW'] = 'ON'
+            self.transition = 'warming'
+            self.transition_ends = time.monotonic() + self.warmup
+            self.reply('*POW=ON#')
+            self.frames_sent += 1
+            self.write(b'0.33PUN\r\n')
+            return
+
+        if value == 'OFF' and self.state['POW'] == 'ON':
+            if self.transition == 'warming':
+                self.blocked += 1
+                self.reply('*Block item#')
+                return
+            self.state['POW'] = 'OFF'
+            self.transition = 'cooling'
+            self.transition_ends = time.monotonic() + self.cooldown
+
+        self.reply(f'*POW={self.state["POW"]}#')
+
+    def set_value(self, token, value):
+        """ Store a value, stepping numbers for "+" and "-" """
+
+        current = self.state.get(token, '0')
+        if value in ('+', '-'):
+            try:
+                step = 1 if value == '+' else -1
+                self.state[token] = str(int(current) + step)
+            except ValueError:
+                pass
+        else:
+            self.state[token] = value.upper()
+
+    def run(self):
+        """ Read frames from the host forever """
+
+        buffer = b''
+        while True:
+            try:
+                data = os.read(self.master, 1024)
+            except OSError:
+                return
+            buffer += data
+            while b'#' in buffer:
+                frame, buffer = buffer.split(b'#', 1)
+                frame = frame.decode('ascii', errors='ignore').strip()
+                if frame:
+                    self.handle(frame)
+
+
+def parse_cli_arguments():
+    """ Parse command-line arguments """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--baud", type=int, default=9600,
+        help='simulated line speed (default: 9600)')
+    parser.add_argument(
+        "--latency", type=float, default=0.02,
+        help='seconds to think before replying (default: 0.02)')
+    parser.add_argument(
+        "--warmup", type=float, default=30.0,
+        help='seconds of lamp warm-up after power on (default: 30)')
+    parser.add_argument(
+        "--cooldown", type=float, default=10.0,
+        help='seconds of cool-down after power off (default: 10)')
+    parser.add_argument(
+        "--power", choices=['ON', 'OFF'], default='OFF',
+        help='power state at startup (default: OFF)')
+    parser.add_argument(
+        "--cr-echo", action="store_true",
+        help='end echoes with CR only, as the projector does')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_cli_arguments()
+    simulator = TK850Simulator(
+        baud=args.baud, latency=args.latency, warmup=args.warmup,
+        cooldown=args.cooldown, power=args.power, cr_echo=args.cr_echo)
+    print(simulator.path, flush=True)
+    simulator.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,9 @@
 
 PRJ_PORT=/dev/ttyUSB0
 PRJ_PORT_BAUD=9600
+# projectionist's multiplexer.path: if it's running and sharing the
+# serial line there, go through it instead of fighting it for the port
+PRJ_SOCKET=${PRJ_SOCKET:-/var/tmp/projectionist.sock}
 
 # Goofy Sh!t I've learned about the TK850:
 #
@@ -55,4 +58,14 @@ case "$1" in
     exit 1
     ;;
 esac
-printf ${PRJ_CMD}'\n' > ${PRJ_PORT}
+if [ -S "${PRJ_SOCKET}" ] && ! command -v socat > /dev/null; then
+  echo "projectionist is sharing the serial line on ${PRJ_SOCKET}, but socat isn't installed;" \
+       "writing to ${PRJ_PORT} directly, which may fight it for the port" >&2
+  PRJ_SOCKET=
+fi
+if [ -n "${PRJ_SOCKET}" ] && [ -S "${PRJ_SOCKET}" ]; then
+  # Prints projectionist's answer, e.g. {"command": "*pow=?#", "ok": true, "value": "ON"}
+  printf ${PRJ_CMD}'\n' | socat -t 30 - UNIX-CONNECT:${PRJ_SOCKET}
+else
+  printf ${PRJ_CMD}'\n' > ${PRJ_PORT}
+fi
@@ -1,9 +1,33 @@
 #!/usr/bin/env python3 -W all
 
 import argparse
+import json
+import os
+import platform
+import socket
+import sys
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+import yaml
+
+import projectionist
 
 VERSION = '0.1.0'
 
+COMMAND_TABLE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'commands.yaml')
+
+# The primary colors the color management settings are kept for
+PRIMARIES = ['red', 'green', 'blue', 'cyan', 'magenta', 'yellow']
+PRIMARY_SETTINGS = ['hue', 'saturation', 'gain']
+
+# Settings that make up a device.calibration, in the order they go in
+CALIBRATION_TOKENS = [
+    'bri', 'con', 'color', 'tint', 'sharp', 'gamma', 'ct', 'RGain', 'GGain',
+    'BGain', 'ROffset', 'GOffset', 'BOffset', 'diris', 'lampm']
+
 
 def parse_cli_arguments():
     """ Parse command-line arguments """
@@ -16,6 +40,51 @@ def parse_cli_arguments():
         default="/dev/serial0",
         help='path to serial device (default: /dev/serial0)',
     )
+    parser.add_argument(
+        "-f",
+        "--config-file",
+        default="config.yaml",
+        help='projectionist configuration, for the MQTT broker and topics '
+             '(default: config.yaml)',
+    )
+    parser.add_argument(
+        "-b",
+        "--baud",
+        type=int,
+        default=9600,
+        help='serial line speed (default: 9600)',
+    )
+    parser.add_argument(
+        "--socket",
+        help='dump: go through the running projectionist\'s serial '
+             'multiplexer socket rather than opening the serial port '
+             '(default: multiplexer.path from the config file, if '
+             'projectionist is listening there)',
+    )
+    parser.add_argument(
+        "--format",
+        choices=['json', 'yaml', 'calibration'],
+        default='yaml',
+        help='dump: output format; "calibration" writes a device.calibration '
+             'list for config.yaml (default: yaml)',
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help='dump: write to this file instead of standard output',
+    )
+    parser.add_argument(
+        "--reply-timeout", type=float, default=1.0,
+        help='dump: seconds to wait for each answer (default: 1)'
+    )
+    parser.add_argument(
+        "--force", action="store_true",
+        help="calibrate: write every setting, not just the ones that differ"
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=60.0,
+        help='seconds to wait for the result (default: 60)'
+    )
     parser.add_argument(
         "-v", "--verbose", action="store_true",
         help="output additional information"
@@ -23,7 +92,7 @@ def parse_cli_arguments():
     parser.add_argument(  # Ideally, this should be a sub_parser
         "command",
         nargs="?",
-        choices=['dump', 'version', 'help'],
+        choices=['dump', 'calibrate', 'version', 'help'],
         help="command to execute"
     )
 
@@ -40,9 +109,244 @@ def parse_cli_arguments():
     return args
 
 
+class SerialSession:
+    """ Ask the projector things over the serial port, with projectionist's
+    ProjectorClient
+
+    Each query is written as soon as the last one has been answered, and
+    replies are matched, retried and timed out just as the daemon does.
+    """
+
+    def __init__(self, port, baud, reply_timeout):
+        self.client = projectionist.ProjectorClient(
+            port, baud=baud, reply_timeout=reply_timeout).open()
+
+    def request(self, frame):
+        """ Send "*frame#" and return (value, error, seconds) """
+
+        started = time.monotonic()
+        value, = self.client.exchange([f'\r*{frame}#\r'.encode()])
+        if value is None:
+            return None, 'no answer', time.monotonic() - started
+        return value, None, time.monotonic() - started
+
+
+class MultiplexerSession:
+    """ Ask the projector things through the running projectionist
+
+    Same requests and answers as SerialSession, but sent over the Unix
+    socket projectionist shares its serial line on, so the service can
+    keep running.  projectionist does its own timeouts and retries.
+    """
+
+    def __init__(self, path):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(path)
+        self.lines = self.socket.makefile('r', encoding='ascii')
+
+    def request(self, frame):
+        """ Send "*frame#" and return (value, error, seconds) """
+
+        started = time.monotonic()
+        self.socket.sendall(f'*{frame}#\n'.encode())
+        line = self.lines.readline()
+        if not line:
+            return None, 'projectionist went away', \
+                time.monotonic() - started
+        answer = json.loads(line)
+        if not answer['ok']:
+            return None, answer['error'], time.monotonic() - started
+        return answer['value'], None, time.monotonic() - started
+
+
+def multiplexer_path(args):
+    """ The socket to go through, if projectionist is sharing the line """
+
+    if args.socket:
+        return args.socket
+    try:
+        with open(args.config_file) as f:
+            config = yaml.safe_load(f)
+    except (OSError, yaml.YAMLError):
+        return None
+    path = ((config or {}).get('multiplexer') or {}).get('path')
+    if path and os.path.exists(path):
+        return path
+    return None
+
+
+def open_session(args):
+    """ A session through projectionist if it's running, else the port """
+
+    path = multiplexer_path(args)
+    if path:
+        if args.verbose:
+            print(f'going through projectionist on {path}', file=sys.stderr)
+        return MultiplexerSession(path), path
+    return SerialSession(args.serial_port, args.baud,
+                         args.reply_timeout), args.serial_port
+
+
+def readable_commands():
+    """ (attribute, token) for every command the projector answers """
+
+    with open(COMMAND_TABLE) as f:
+        commands = yaml.safe_load(f)['commands']
+    return [(command['attribute'], str(command['token']))
+            for command in commands if command.get('read')]
+
+
+def dump(args):
+    """ Sweep every readable setting, and the color management settings
+    of each primary color """
+
+    session, port = open_session(args)
+    started = time.monotonic()
+
+    def query(token):
+        value, error, seconds = session.request(f'{token}=?')
+        if args.verbose:
+            print(f'{token}={value if error is None else error} '
+                  f'({1000 * seconds:.1f}ms)', file=sys.stderr)
+        result = {'token': token, 'value': value,
+                  'ms': round(1000 * seconds, 1)}
+        if error is not None:
+            result['error'] = error
+        return result
+
+    settings = {attribute: query(token)
+                for attribute, token in readable_commands()}
+
+    # The hue, saturation and gain answers are for whichever primary is
+    #   selected, so select each in turn and put the original back after
+    primaries = {}
+    original = settings.get('primary_color', {}).get('value')
+    if original is not None:
+        for primary in PRIMARIES:
+            _, error, _ = session.request(f'primcr={primary}')
+            if error is None:
+                primaries[primary] = {
+                    token: query(token) for token in PRIMARY_SETTINGS}
+        session.request(f'primcr={original.lower()}')
+
+    return {
+        'port': port,
+        'seconds': round(time.monotonic() - started, 2),
+        'settings': settings,
+        'primaries': primaries,
+    }
+
+
+def calibration_entries(result):
+    """ The dump as a device.calibration list ("bri=50", ...) """
+
+    def entry(token, value):
+        try:
+            float(value)
+        except ValueError:
+            value = value.lower()
+        return f'{token}={value}'
+
+    values = {setting['token'].lower(): setting['value']
+              for setting in result['settings'].values()}
+    entries = [entry(token, values[token.lower()])
+               for token in CALIBRATION_TOKENS
+               if values.get(token.lower()) is not None]
+    for primary, settings in result['primaries'].items():
+        entries.append(f'primcr={primary}')
+        entries += [entry(token, setting['value'])
+                    for token, setting in settings.items()
+                    if setting['value'] is not None]
+    return entries
+
+
+def write_dump(args, result):
+    """ Print or save the dump in the format asked for """
+
+    if args.format == 'json':
+        text = json.dumps(result, indent=2) + '\n'
+    elif args.format == 'yaml':
+        text = yaml.safe_dump(result, sort_keys=False)
+    else:
+        text = yaml.safe_dump(
+            {'calibration': calibration_entries(result)}, sort_keys=False)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text)
+
+    answered = sum(1 for setting in result['settings'].values()
+                   if setting['value'] is not None)
+    print(f"{answered} of {len(result['settings'])} setting(s) read "
+          f"in {result['seconds']}s", file=sys.stderr)
+
+
+def topic_base(config):
+    """ The topic base projectionist uses for the configured projector """
+
+    topic = config['mqtt']['topic']
+    node_id = topic['node_id']
+    if node_id == 'HOSTNAME':
+        node_id = platform.node()
+    return f"{topic['prefix']}/{node_id}/{topic['object_id']}"
+
+
+def calibrate(args):
+    """ Ask the running projectionist to apply device.calibration
+
+    projectionist reads back the projector's settings and writes only
+    the ones that differ; this waits for its report on <base>/calibration.
+    """
+
+    with open(args.config_file) as f:
+        config = yaml.safe_load(f)
+    base = topic_base(config)
+    result = {}
+    answered = threading.Event()
+
+    def on_connect(client, userdata, flags, rc):
+        client.subscribe(base + '/calibration')
+        client.publish(base + '/calibration/set',
+                       'force' if args.force else 'apply')
+
+    def on_message(client, userdata, msg):
+        result.update(json.loads(msg.payload))
+        answered.set()
+
+    client = mqtt.Client()
+    client.on_connect = on_connect
+    client.on_message = on_message
+    if config['mqtt']['useTLS']:
+        client.tls_set()
+    client.username_pw_set(config['mqtt']['username'],
+                           config['mqtt']['password'])
+    client.connect(config['mqtt']['hostname'], config['mqtt']['portnumber'])
+    client.loop_start()
+    answered.wait(args.timeout)
+    client.disconnect()
+    client.loop_stop()
+
+    if not result:
+        sys.exit(f'no answer on {base}/calibration, is projectionist running'
+                 ' and the projector on?')
+    if args.verbose:
+        print(json.dumps(result, indent=2))
+    else:
+        print(f"{len(result['changed'])} of {result['checked']} setting(s) "
+              f"changed in {result['seconds']}s")
+    for frame in result['failed']:
+        print(f'failed: {frame}', file=sys.stderr)
+    return 1 if result['failed'] else 0
+
+
 def main():
     args = parse_cli_arguments()
-    print(args)
+    if args.command == 'calibrate':
+        sys.exit(calibrate(args))
+    elif args.command == 'dump':
+        write_dump(args, dump(args))
 
 
 if __name__ == "__main__":
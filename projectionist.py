@@ -16,109 +16,1591 @@ import argparse
 import queue
 import threading
 import os
+import asyncio
+import collections
+import re
+import bisect
+import http.server
+import base64
+import struct
+import urllib.parse
+import socket
+import socketserver
+import stat
 
 # Paho MQTT client to interface with Home Asssitant.
 #   https://www.eclipse.org/paho/clients/python/docs/
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 
 # pySerial for COM port access
 #   https://pyserial.readthedocs.io/en/latest/
 import serial
 
+# pySerial-asyncio for COM port access from the event loop
+#   https://pyserial-asyncio.readthedocs.io/en/latest/
+import serial_asyncio
+
 # PyYAML for config files
 import yaml
 
 # JSON for config topics
 import json
+import hashlib
+import hmac
 
-# systemd components
-import systemd.daemon
-import systemd.journal
+# systemd components are imported where the daemon uses them, so
+#   ProjectorClient can be imported on hosts without python3-systemd
 
 ################################################################
 # Global script variables.
-serial_port = None
 client = None
 config = None
+devices = []
+devices_by_topic = {}
 original_sigint_handler = None
 original_sigterm_handler = None
 original_sig_pipethandler = None
 publishQ = None
-serialQ = None
 log = None
 client_is_connected = False
+shutting_down = threading.Event()
+event_loop = None
+main_task = None
 
 ################################################################
 # Initial Setup
+#
+# Importing this file starts nothing.  The daemon (command line, config,
+# signal handlers, serial ports and MQTT) is set up and run by main(),
+# at the bottom, so other scripts can import ProjectorClient and the
+# rest without launching it.
+
+# get an instance of the logger object this module will use
+logger = logging.getLogger("projectionist")
 
 # ----------------------------------------------------------------
-# Parse CLI arguments
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument(
-        "-f",
-        "--config-file",
-        default="config.yaml",
-        help="load configuration from CONFIG_FILE",
-    )
-    parser.add_argument(
-        "-v", "--verbose", action="store_true",
-        help="output additional information"
-    )
-    args = parser.parse_args()
+# Initial setup of the outbound publish queue.  It is shared by all of
+# the devices, since they all go out over the same MQTT client.
+publishQ = queue.Queue()
+
+# Set by main() from the command line and the config file
+args = None
+queue_timeout = None
+worker_mode = None
+
+################################################################
+# Protocol codec
+#
+# Everything we know about the projector's commands comes from the
+# command table in commands.yaml, loaded once at startup.  It maps each
+# MQTT attribute to its serial token both ways: encoding /set payloads
+# into commands, and decoding "*TOKEN=value#" replies by looking the
+# token up in a dict rather than trying each prefix in turn.
+
+# Numbers, signed numbers, decimals ("2.3") or a bare "+"/"-" step
+numeric_payload = re.compile(r"^([+-]?[0-9]+(\.[0-9]+)?|[+-])$")
+
+
+class Command:
+    def __init__(self, entry):
+        self.attribute = entry["attribute"]
+        self.token = str(entry["token"])
+        self.readable = entry.get("read", False)
+        self.poll = entry.get("poll", False)
+        self.values = {
+            str(payload).upper(): str(value)
+            for payload, value in (entry.get("values") or {}).items()}
+        self.numeric = entry.get("numeric", False)
+        self.bare = entry.get("bare", False)
+        self.preserve_case = entry.get("preserve_case", False)
+        self.needs_power = entry.get("needs_power", False)
+        self.writable = bool(self.values) or self.numeric
+
+    # ----------------------------------------------------------------
+    # Turn an MQTT payload into the command bytes, or None if the
+    #   payload isn't one this command takes
+    def encode(self, payload):
+        payload = payload.decode(encoding="ascii", errors="ignore").strip()
+        value = self.values.get(payload.upper())
+        if value is None and self.numeric and numeric_payload.match(payload):
+            value = payload
+        if value is None:
+            return None
+        if self.bare:
+            return f"\r*{value}#\r".encode()
+        return f"\r*{self.token}={value}#\r".encode()
+
+    # ----------------------------------------------------------------
+    # Does the payload set a value outright, so that a newer one for the
+    #   same command makes it pointless?  Steps ("+", "-") and bare
+    #   commands (navigate, reset_picture) each do something of their own.
+    def absolute(self, payload):
+        payload = payload.decode(encoding="ascii", errors="ignore").strip()
+        return not self.bare and payload not in ("+", "-")
+
+    # ----------------------------------------------------------------
+    # The command that asks for the current value, if there is one
+    def query(self):
+        if not self.readable:
+            return None
+        return f"\r*{self.token}=?#\r".encode()
+
+    # ----------------------------------------------------------------
+    # Turn the value from a reply into the MQTT payload
+    def decode(self, value):
+        return value if self.preserve_case else value.upper()
+
+
+class Codec:
+    def __init__(self, entries):
+        self.commands = [Command(entry) for entry in entries]
+        self.by_attribute = {
+            command.attribute: command for command in self.commands}
+        self.by_reply_token = {
+            command.token.upper().encode(): command
+            for command in self.commands if not command.bare}
+        self.poll_commands = [
+            command for command in self.commands if command.poll]
+        self.writable_attributes = [
+            command.attribute for command in self.commands
+            if command.writable]
+
 
 # ----------------------------------------------------------------
-# Setup logger to systemd or STDOUT
+# Load the command table, relative to this script unless it's absolute
+def load_codec(filename):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), filename)
+    with open(path) as f:
+        codec = Codec(yaml.safe_load(f)["commands"])
+    logger.info(
+        f'Command table loaded from "{path}": {len(codec.commands)} commands')
+    return codec
 
-# get an instance of the logger object this module will use
-logger = logging.getLogger("projectionist")
-logger.propagate = False
 
-# how much output?
-if args.verbose:
-    logLevel = logging.DEBUG
-else:
-    logLevel = logging.WARNING
-logger.setLevel(logLevel)
+# The daemon's command table, loaded by main()
+codec = None
 
-# Send all logging messages to the journal
-logging.root.addHandler(systemd.journal.JournalHandler())
-logger.addHandler(systemd.journal.JournalHandler())
 
-logger.info(
-    "Projectionist v1.1.2 - Heading into the booth ... It's aliiive!"
-)
+# ----------------------------------------------------------------
+# Split the bytes coming off the serial port into frames
+#   Replies and echoes end in "#" (">*pow=?#" with just a CR after it,
+#   "*POW=ON#" with CR LF); the odd status line like "0.33PUN" ends in
+#   CR or LF.  Bytes go into one reusable buffer and each frame comes
+#   out as soon as its terminator arrives, still as bytes.  Whatever is
+#   left is the start of the next frame.
+frame_terminator = re.compile(rb"[#\r\n]")
+
+
+class SerialFramer:
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+        frames = []
+        start = 0
+        for match in frame_terminator.finditer(self.buffer):
+            end = match.end()
+            frame = bytes(self.buffer[start:end if match.group() == b"#"
+                                      else match.start()]).strip()
+            if frame:
+                frames.append(frame)
+            start = end
+        del self.buffer[:start]
+        return frames
+
+
+################################################################
+# Metrics
+#
+# Counters and histograms for the serial line and the MQTT side, so we
+# can tell a saturated serial line or a struggling broker from the
+# outside.  They're served as Prometheus text on a local port (the
+# "metrics" section of the config) and can be published as Home
+# Assistant diagnostic sensors too.  Samples are keyed by their labels,
+# usually the device's topic base.
+
+histogram_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                     5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.families = {}
+        self.samples = {}
+        self.collectors = {}
+
+    # ----------------------------------------------------------------
+    # Declare a metric: "counter", "histogram", or "gauge" with a
+    #   collect() that returns [(labels, value), ...] when scraped
+    def declare(self, name, kind, help_text, collect=None):
+        self.families[name] = (kind, help_text)
+        self.samples[name] = {}
+        if collect is not None:
+            self.collectors[name] = collect
+
+    def inc(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            family = self.samples[name]
+            family[key] = family.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            family = self.samples[name]
+            if key not in family:
+                family[key] = Histogram(histogram_buckets)
+            family[key].observe(value)
+
+    # ----------------------------------------------------------------
+    # The current value of a counter, or a (sum, count) for a histogram
+    def value(self, name, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            sample = self.samples[name].get(key)
+            if self.families[name][0] == "histogram":
+                return (0.0, 0) if sample is None \
+                    else (sample.sum, sample.count)
+            return sample or 0
+
+    # ----------------------------------------------------------------
+    # Everything, in the Prometheus text exposition format
+    #   https://prometheus.io/docs/instrumenting/exposition_formats/
+    def render(self):
+        def format_labels(labels):
+            if not labels:
+                return ""
+            return "{" + ",".join(
+                f'{name}="{value}"' for name, value in labels) + "}"
+
+        lines = []
+        for name, (kind, help_text) in self.families.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+            if name in self.collectors:
+                for labels, value in self.collectors[name]():
+                    lines.append(
+                        f"{name}{format_labels(sorted(labels.items()))} {value}")
+                continue
+
+            with self.lock:
+                samples = list(self.samples[name].items())
+            for key, sample in samples:
+                if kind != "histogram":
+                    lines.append(f"{name}{format_labels(key)} {sample}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(sample.buckets + ("+Inf",),
+                                        sample.counts):
+                    cumulative += count
+                    lines.append(
+                        f"{name}_bucket{format_labels(key + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(key)} {sample.sum}")
+                lines.append(f"{name}_count{format_labels(key)} {sample.count}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+metrics.declare("projectionist_serial_commands_sent_total", "counter",
+                "Commands written to the serial port, retries included")
+metrics.declare("projectionist_serial_retries_total", "counter",
+                "Commands written again after getting no reply")
+metrics.declare("projectionist_serial_commands_dropped_total", "counter",
+                "Commands given up on after running out of retries")
+metrics.declare("projectionist_serial_commands_superseded_total", "counter",
+                "Queued commands replaced by a newer one with the same key")
+metrics.declare("projectionist_serial_replies_matched_total", "counter",
+                "Replies and echoes matched to the command in flight")
+metrics.declare("projectionist_serial_commands_refused_total", "counter",
+                "Commands the projector refused (Block item and the like)")
+metrics.declare("projectionist_serial_unknown_frames_total", "counter",
+                "Serial input that didn't parse as anything we know")
+metrics.declare("projectionist_serial_round_trip_seconds", "histogram",
+                "Time from writing a command to its reply")
+metrics.declare("projectionist_serial_queue_depth", "gauge",
+                "Commands waiting to go out, by lane",
+                collect=lambda: [
+                    ({"device": device.mqtt_topic, "lane": lane}, size)
+                    for device in devices
+                    for lane, size in device.serialQ.lane_sizes().items()])
+metrics.declare("projectionist_serial_reconnects_total", "counter",
+                "Serial ports reopened after failing")
+metrics.declare("projectionist_serial_connected", "gauge",
+                "Whether the serial port is open and working",
+                collect=lambda: [({"device": device.mqtt_topic},
+                                  int(device.serial_online))
+                                 for device in devices])
+metrics.declare("projectionist_worker_restarts_total", "counter",
+                "Worker threads (or tasks) restarted after dying")
+metrics.declare("projectionist_publish_wait_seconds", "histogram",
+                "Time messages spend on the publish queue")
+metrics.declare("projectionist_publish_failures_total", "counter",
+                "Messages the MQTT client wouldn't take")
+metrics.declare("projectionist_publish_queue_depth", "gauge",
+                "Messages waiting to be published",
+                collect=lambda: [({}, publishQ.qsize())])
+metrics.declare("projectionist_publish_spool_dropped_total", "counter",
+                "Messages dropped because the spool was full")
+metrics.declare("projectionist_mqtt_connects_total", "counter",
+                "Successful connections to the MQTT broker")
+metrics.declare("projectionist_mqtt_reconnects_total", "counter",
+                "Connections to the MQTT broker after the first")
+metrics.declare("projectionist_mqtt_connected", "gauge",
+                "Whether we're connected to the MQTT broker",
+                collect=lambda: [({}, int(client_is_connected))])
+
 
 # ----------------------------------------------------------------
-# Initial setup of the inbound and outbound queues
-publishQ = queue.Queue()
-serialQ = queue.Queue()
+# Serve the metrics over HTTP for Prometheus to scrape
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"metrics {self.address_string()} {format % args}")
+
+
+def start_metrics_server():
+    metrics_config = config.get("metrics") or {}
+    if not metrics_config.get("port"):
+        return
+    address = metrics_config.get("address", "127.0.0.1")
+    # Metrics are optional, so a port that's taken isn't worth dying for
+    try:
+        server = http.server.ThreadingHTTPServer(
+            (address, metrics_config["port"]), MetricsRequestHandler)
+    except OSError as e:
+        logger.error(
+            f'metrics server failed to start on {address}:{metrics_config["port"]}, carrying on without it: error="{e}"')
+        return
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(
+        f"Serving metrics on http://{address}:{metrics_config['port']}/metrics")
+
 
 ################################################################
-# Load config from file
-with open(args.config_file) as f:
-    config = yaml.safe_load(f)
+# Flight recorder
+#
+# The last few thousand serial frames in and out and MQTT messages in
+# and out, each with its monotonic timestamp, kept in a ring buffer.
+# Recording is just a deque append of the raw bytes, so it can stay on
+# all the time; nothing is formatted until the buffer is dumped to a
+# file, on SIGUSR1, when a serial port fails or when a worker dies.
+
+
+class FlightRecorder:
+    def __init__(self, size, path):
+        self.entries = collections.deque(maxlen=size)
+        self.path = path
+
+    # ----------------------------------------------------------------
+    # direction is "serial<", "serial>", "mqtt<" or "mqtt>"; source is
+    #   the device's topic base for serial, the topic for MQTT
+    def record(self, direction, source, data):
+        self.entries.append((time.monotonic(), direction, source, data))
+
+    def dump(self, reason):
+        if not self.path:
+            return None
+        now = time.monotonic()
+        path = time.strftime(self.path)
+        entries = list(self.entries)
+        try:
+            with open(path, "w") as f:
+                f.write(f"# projectionist flight recorder: {reason}\n")
+                f.write(f"# dumped {time.strftime('%Y-%m-%dT%H:%M:%S%z')}, monotonic {now:.6f}, {len(entries)} entries\n")
+                for timestamp, direction, source, data in entries:
+                    f.write(f"{timestamp:.6f} {timestamp - now:+11.6f} {direction} {source} {data!r}\n")
+        except OSError as e:
+            logger.error(f'flight recorder dump error path="{path}" error="{e}"')
+            return None
+        logger.warning(f'Flight recorder dumped to "{path}" ({reason})')
+        return path
+
+
+# Set up by main() from the "flight_recorder" section
+flight_recorder = None
+
+################################################################
+# Worker supervision
+#
+# Every worker thread (or, in asyncio mode, task) is started by the
+# supervisor and calls supervisor.beat() each time round its loop,
+# including when it wakes up with nothing to do, so no worker goes more
+# than queue_timeout seconds without a beat.  Once a second the main
+# thread (or the event loop) checks on them all: a worker that has died
+# is logged, leaves a flight recorder dump behind and is started again,
+# and only if every worker has beaten within its deadline does systemd
+# get a WATCHDOG=1.  A worker that's stuck rather than dead stops the
+# pings, and systemd restarts the service after WatchdogSec.
+
+supervisor_interval = 1.0
 
-logger.info(f'Configuration loaded from "{args.config_file}": {config}')
 
 # ----------------------------------------------------------------
-# Setup composite config elements
-if config["mqtt"]["topic"]["node_id"] == "HOSTNAME":
-    config["mqtt"]["topic"]["node_id"] = platform.node()
+# Tell systemd how the service is getting on (READY=1, WATCHDOG=1, ...)
+def notify_systemd(status):
+    import systemd.daemon
+    systemd.daemon.notify(status)
+
+
+class Worker:
+    def __init__(self, name, target, args):
+        self.name = name
+        self.target = target
+        self.args = args
+        self.runner = None
+        self.beat_at = None
+
+    # ----------------------------------------------------------------
+    # Is the thread or task still running?
+    def alive(self):
+        if isinstance(self.runner, threading.Thread):
+            return self.runner.is_alive()
+        return not self.runner.done()
+
+
+class Supervisor:
+    def __init__(self):
+        self.workers = []
+        self.by_runner = {}
+        self.stale = set()
+
+    # ----------------------------------------------------------------
+    # Start target(*args) as a supervised worker: a task on the event
+    #   loop for coroutines, otherwise a daemon thread
+    def start(self, name, target, *args):
+        worker = Worker(name, target, args)
+        self.workers.append(worker)
+        self._run(worker)
+        return worker
+
+    def _run(self, worker):
+        worker.beat_at = time.monotonic()
+        if asyncio.iscoroutinefunction(worker.target):
+            worker.runner = event_loop.create_task(
+                worker.target(*worker.args), name=worker.name)
+            self.by_runner[worker.runner] = worker
+        else:
+            worker.runner = threading.Thread(
+                target=worker.target, args=worker.args, name=worker.name,
+                daemon=True)
+            worker.runner.start()
+            self.by_runner[worker.runner.ident] = worker
+
+    # ----------------------------------------------------------------
+    # Called by a worker to say it's still making progress
+    def beat(self):
+        if event_loop is not None:
+            runner = asyncio.current_task()
+        else:
+            runner = threading.get_ident()
+        worker = self.by_runner.get(runner)
+        if worker is not None:
+            worker.beat_at = time.monotonic()
+
+    # ----------------------------------------------------------------
+    # Restart any dead workers, then ping the watchdog if they've all
+    #   been heard from recently enough
+    def check(self):
+        for worker in self.workers:
+            if worker.alive():
+                continue
+            if isinstance(worker.runner, threading.Thread):
+                self.by_runner.pop(worker.runner.ident, None)
+                error = "thread exited"
+            else:
+                self.by_runner.pop(worker.runner, None)
+                error = repr(worker.runner.exception()) \
+                    if not worker.runner.cancelled() else "cancelled"
+            message = f'worker {worker.name} died error="{error}", restarting it'
+            logger.error(message)
+            flight_recorder.dump(message)
+            metrics.inc("projectionist_worker_restarts_total",
+                        worker=worker.name)
+            self._run(worker)
+
+        now = time.monotonic()
+        deadline = 2 * queue_timeout
+        stale = {worker.name for worker in self.workers
+                 if now - worker.beat_at > deadline}
+        if stale and stale != self.stale:
+            logger.warning(
+                f"workers {sorted(stale)} not heard from for over {deadline}s, holding off the watchdog")
+        self.stale = stale
+        if not stale:
+            notify_systemd("WATCHDOG=1")
+
+
+supervisor = Supervisor()
 
-# topic: <prefix>/[<node_id>/]<object_id>
-mqtt_topic = f"{config['mqtt']['topic']['prefix']}/{config['mqtt']['topic']['node_id']}/{config['mqtt']['topic']['object_id']}"
-logger.debug(f"MQTT using topic base: {mqtt_topic}")
 
-# LWT := Last will and testament
-availability_topic = mqtt_topic + "/LWT"
-logger.debug(f"MQTT using availability topic: {availability_topic}")
+################################################################
+# Publish spool
+#
+# While the broker is unreachable, outbound messages wait here instead
+# of piling up on (or being dropped from) the publishQ.  The spool is
+# bounded: past spool.limit the oldest messages are dropped.  A retained
+# message replaces any spooled one for the same topic, since only the
+# last would stick anyway.  With spool.path set it's also written to
+# disk, so it survives a restart: every spool_save_interval seconds
+# while it's changing, after each batch and at shutdown, rather than on
+# every message.
+#
+# Once we're connected again the publishQ worker flushes it in batches
+# at QoS 1.  A batch only goes out once the broker has acknowledged
+# enough of the last one (on_mqtt_publish tells us), so a long outage
+# doesn't turn into a flood.  New messages queue behind the spool until
+# it's empty, to keep them in order.
+#
+# Like the scheduler, the spool doesn't do any I/O itself apart from its
+# file, and nothing that calls mqtt_publish ever waits on it.
+
+spool_save_interval = 5.0
+
+
+class PublishSpool:
+    def __init__(self, limit, path, batch_size):
+        self.limit = limit
+        self.path = path
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.messages = collections.OrderedDict()
+        self.in_flight = {}
+        self.acked_early = set()
+        self.publishing = False
+        self.sequence = 0
+        self.dirty = False
+        self.saved_at = 0
+        self.load()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.messages) + len(self.in_flight)
+
+    # ----------------------------------------------------------------
+    # Spool a (topic, payload, retain, queued_at) message
+    def add(self, message):
+        topic, payload, retain, queued_at = message
+        with self.lock:
+            if retain:
+                key = ("retained", topic)
+                self.messages.pop(key, None)
+            else:
+                key = self.sequence
+                self.sequence += 1
+            self.messages[key] = message
+
+            while len(self.messages) > self.limit:
+                _, (dropped, _, _, _) = self.messages.popitem(last=False)
+                metrics.inc("projectionist_publish_spool_dropped_total")
+                logger.warning(
+                    f'publish spool full ({self.limit}), dropped message for "{dropped}"')
+            self.dirty = True
+
+    # ----------------------------------------------------------------
+    # Take the next batch to publish, as much of batch_size as isn't
+    #   still waiting to be acknowledged
+    def take_batch(self):
+        with self.lock:
+            batch = []
+            while self.messages and \
+                    len(batch) + len(self.in_flight) < self.batch_size:
+                batch.append(self.messages.popitem(last=False)[1])
+            return batch
+
+    # ----------------------------------------------------------------
+    # Put messages from a batch that couldn't be published back in front
+    def put_back(self, messages):
+        with self.lock:
+            for message in reversed(messages):
+                if message[2]:
+                    key = ("retained", message[0])
+                else:
+                    key = self.sequence
+                    self.sequence += 1
+                if key not in self.messages:
+                    self.messages[key] = message
+                    self.messages.move_to_end(key, last=False)
+            self._save()
+
+    # ----------------------------------------------------------------
+    # A spooled message is about to be handed to the client, and has
+    #   been, as mid (None if the client wouldn't take it).  The ack can
+    #   beat sent() to it, but only while the publish is under way: the
+    #   lock can't be held across it, as paho calls on_publish with its
+    #   own lock held.
+    def sending(self):
+        with self.lock:
+            self.publishing = True
+            self.acked_early.clear()
+
+    def sent(self, mid, message):
+        with self.lock:
+            self.publishing = False
+            if mid is not None and mid not in self.acked_early:
+                self.in_flight[mid] = message
+            self.acked_early.clear()
+
+    # ----------------------------------------------------------------
+    # Called from on_mqtt_publish.  Returns True if it was one of ours
+    #   and there's more to flush.  Anything else (a QoS 0 publish, say)
+    #   is ignored, unless it might be the ack for the message being
+    #   published right now.
+    def acknowledged(self, mid):
+        with self.lock:
+            if self.in_flight.pop(mid, None) is None:
+                if self.publishing:
+                    self.acked_early.add(mid)
+                return False
+            if not self.in_flight and not self.messages:
+                self._save()
+            return bool(self.messages)
+
+    def batch_done(self):
+        with self.lock:
+            self._save()
+
+    # ----------------------------------------------------------------
+    # Write out changes once spool_save_interval has passed since the
+    #   last write, and say how long the publishQ worker can wait
+    #   before calling again
+    def save_if_due(self, timeout):
+        with self.lock:
+            if not self.dirty or not self.path:
+                return timeout
+            wait = self.saved_at + spool_save_interval - time.monotonic()
+            if wait <= 0:
+                self._save()
+                return timeout
+            return min(timeout, wait)
+
+    # ----------------------------------------------------------------
+    # Write the spool to disk (or remove the file once it's empty)
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        self.dirty = False
+        self.saved_at = time.monotonic()
+        if not self.path:
+            return
+        messages = list(self.in_flight.values()) + list(self.messages.values())
+        try:
+            if not messages:
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                return
+            with open(self.path + ".tmp", "w") as f:
+                json.dump([[topic, payload if isinstance(payload, str)
+                            else payload.decode(errors="replace"), retain]
+                           for topic, payload, retain, _ in messages], f)
+            os.replace(self.path + ".tmp", self.path)
+        except OSError as e:
+            logger.error(f'publish spool write error path="{self.path}" error="{e}"')
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f'publish spool read error path="{self.path}" error="{e}"')
+            return
+        now = time.monotonic()
+        for topic, payload, retain in saved:
+            self.add((topic, payload, retain, now))
+        logger.info(
+            f'Loaded {len(saved)} spooled message(s) from "{self.path}"')
+
+
+# Set up by main() from mqtt.spool
+spool = None
+metrics.declare("projectionist_publish_spool_depth", "gauge",
+                "Messages spooled or in flight while flushing the spool",
+                collect=lambda: [({}, len(spool))])
+
+
+################################################################
+# Command scheduler
+#
+# Commands for the projector go out one at a time, and each one waits
+# for its answer before the next is sent.  "*pow=?#" is answered by
+# "*POW=...#", so the reply is matched on the token in front of the "=".
+# Commands without an "=" ("*up#", "*enter#") get no reply, so for those
+# the projector's ">" echo of the command is the answer.  Anything that
+# isn't answered within its timeout is sent again, up to a retry limit,
+# and then dropped.  There is no fixed pause between commands.
+#
+# Commands can be queued with a coalescing key.  While a command with
+# that key is still waiting to go out, a newer one with the same key
+# takes its place in the queue instead of queueing behind it, so a burst
+# of /set messages ends up as just the last value on the wire.  The
+# superseded ones are counted and logged.
+#
+# The queue has three lanes, served in priority order: interactive
+# commands (someone pressed something), confirmation reads (checking up
+# on a state change) and background polls.  So a power/set never waits
+# behind a poll batch, yet a lower lane whose oldest command has waited
+# max_lane_wait seconds gets the next turn, so polls are never starved.
+#
+# The scheduler doesn't do any I/O itself.  The serialQ workers ask it
+# for the next command to write, wait on its condition (or on an event
+# set by its waker, from the event loop) until it has something, and
+# tell it about replies as parse_serial_input finds them.
+#
+# Whoever queues a command can also ask to be called back with the
+# answer: the reply's value ("ON" for "*POW=ON#"), "" when an echo was
+# the answer, or None if the command was refused or dropped.  A command
+# that supersedes another takes over its callbacks too.  Callbacks run
+# with the scheduler's lock held, so they should only queue more
+# commands or hand the answer off, never wait.
+
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_CONFIRM = 1
+PRIORITY_POLL = 2
+priority_names = ("interactive", "confirm", "poll")
+
+
+class PendingCommand:
+    def __init__(self, cmd, timeout, coalesce=None,
+                 priority=PRIORITY_INTERACTIVE, callback=None):
+        self.cmd = cmd
+        self.timeout = timeout
+        self.coalesce = coalesce
+        self.priority = priority
+        self.callbacks = [] if callback is None else [callback]
+        self.attempts = 0
+        self.queued_at = time.monotonic()
+        self.sent_at = None
+
+        # "\r*pow=?#\r" -> frame "*pow=?#", reply key "POW"
+        self.frame = cmd.strip().decode(encoding="ascii", errors="ignore")
+        body = self.frame.strip("*#")
+        if "=" in body:
+            self.key = body.split("=", 1)[0].strip().upper()
+        else:
+            self.key = None
+
+
+class CommandScheduler:
+    def __init__(self, name, reply_timeout, retries, command_timeouts,
+                 max_lane_wait):
+        self.name = name
+        self.condition = threading.Condition()
+        self.waker = None
+        self.lanes = [collections.deque() for _ in priority_names]
+        self.coalescing = {}
+        self.superseded = 0
+        self.in_flight = None
+        self.held = False
+        self.configure(reply_timeout, retries, command_timeouts, max_lane_wait)
+
+    # ----------------------------------------------------------------
+    # Take on new timeouts and retry counts; commands already queued
+    #   keep the timeout they were given
+    def configure(self, reply_timeout, retries, command_timeouts,
+                  max_lane_wait):
+        with self.condition:
+            self.reply_timeout = reply_timeout
+            self.retries = retries
+            self.command_timeouts = {
+                key.upper(): value for key, value in command_timeouts.items()}
+            self.max_lane_wait = max_lane_wait
+
+    # ----------------------------------------------------------------
+    # Wake up whoever is waiting to send; call with the condition held
+    def _notify(self):
+        self.condition.notify_all()
+        if self.waker is not None:
+            self.waker()
+
+    # ----------------------------------------------------------------
+    # Add a raw command to the end of its lane, or in place of the
+    #   waiting command with the same coalescing key.  If that one is in
+    #   a different lane, the command goes in the more urgent of the two.
+    def put(self, cmd, timeout=None, coalesce=None,
+            priority=PRIORITY_INTERACTIVE, callback=None):
+        pending = PendingCommand(cmd, timeout, coalesce, priority, callback)
+        if pending.timeout is None:
+            pending.timeout = self.command_timeouts.get(
+                pending.key, self.reply_timeout)
+        with self.condition:
+            superseded = self.coalescing.get(coalesce)
+            if superseded is not None:
+                self.superseded += 1
+                pending.callbacks[:0] = superseded.callbacks
+                metrics.inc("projectionist_serial_commands_superseded_total",
+                            device=self.name)
+                logger.debug(
+                    f'serialQ {self.name} "{pending.frame}" supersedes "{superseded.frame}" ({self.superseded} superseded so far)')
+
+            if superseded is not None and superseded.priority <= priority:
+                pending.priority = superseded.priority
+                lane = self.lanes[pending.priority]
+                lane[lane.index(superseded)] = pending
+            else:
+                if superseded is not None:
+                    self.lanes[superseded.priority].remove(superseded)
+                self.lanes[pending.priority].append(pending)
+
+            if coalesce is not None:
+                self.coalescing[coalesce] = pending
+            self._notify()
+
+    def qsize(self):
+        with self.condition:
+            return sum(len(lane) for lane in self.lanes)
+
+    def lane_sizes(self):
+        with self.condition:
+            return {name: len(lane)
+                    for name, lane in zip(priority_names, self.lanes)}
+
+    # ----------------------------------------------------------------
+    # Stop handing out commands while the serial port is down.  The one
+    #   in flight goes back to the front of its lane, to be sent again
+    #   with a fresh set of retries once the port is back.
+    def hold(self):
+        with self.condition:
+            self.held = True
+            pending = self.in_flight
+            if pending is not None:
+                self.in_flight = None
+                pending.attempts = 0
+                self.lanes[pending.priority].appendleft(pending)
+                if pending.coalesce is not None:
+                    self.coalescing.setdefault(pending.coalesce, pending)
+
+    def release(self):
+        with self.condition:
+            self.held = False
+            self._notify()
+
+    # ----------------------------------------------------------------
+    # Take the next command to send: the head of the most urgent lane,
+    #   unless a less urgent lane's head has waited too long
+    def _pop_next(self, now):
+        for lane in reversed(self.lanes):
+            if lane and now - lane[0].queued_at >= self.max_lane_wait:
+                return lane.popleft()
+        for lane in self.lanes:
+            if lane:
+                return lane.popleft()
+        return None
+
+    # ----------------------------------------------------------------
+    # Decide what to write next.  Returns (command, None) if a command
+    #   should be written now, or (None, seconds) for how long to wait
+    #   before asking again (None meaning until woken up, as while the
+    #   queue is held).
+    def next_command(self):
+        with self.condition:
+            if self.held:
+                return None, None
+            now = time.monotonic()
+
+            if self.in_flight is not None:
+                waited = now - self.in_flight.sent_at
+                if waited < self.in_flight.timeout:
+                    return None, self.in_flight.timeout - waited
+
+                if self.in_flight.attempts <= self.retries:
+                    logger.debug(
+                        f'serialQ {self.name} no reply to "{self.in_flight.frame}" after {waited:.3f}s, retrying')
+                    self.in_flight.attempts += 1
+                    self.in_flight.sent_at = now
+                    metrics.inc("projectionist_serial_retries_total",
+                                device=self.name)
+                    metrics.inc("projectionist_serial_commands_sent_total",
+                                device=self.name)
+                    return self.in_flight.cmd, None
+
+                metrics.inc("projectionist_serial_commands_dropped_total",
+                            device=self.name)
+                logger.warning(
+                    f'serialQ {self.name} no reply to "{self.in_flight.frame}" after {self.in_flight.attempts} attempts, dropping it')
+                dropped = self.in_flight
+                self.in_flight = None
+                for callback in dropped.callbacks:
+                    callback(None)
+
+            self.in_flight = self._pop_next(now)
+            if self.in_flight is None:
+                return None, None
+
+            self.coalescing.pop(self.in_flight.coalesce, None)
+            self.in_flight.attempts += 1
+            self.in_flight.sent_at = now
+            metrics.inc("projectionist_serial_commands_sent_total",
+                        device=self.name)
+            return self.in_flight.cmd, None
+
+    # ----------------------------------------------------------------
+    # The command in flight has been answered (or refused)
+    def _complete(self, outcome, reply=None):
+        pending = self.in_flight
+        self.in_flight = None
+        now = time.monotonic()
+        metrics.observe("projectionist_serial_round_trip_seconds",
+                        now - pending.sent_at, device=self.name)
+        logger.debug(
+            f'serialQ {self.name} "{pending.frame}" {outcome} after {1000 * (now - pending.sent_at):.1f}ms ({1000 * (now - pending.queued_at):.1f}ms since queued, {pending.attempts} attempt(s))')
+        for callback in pending.callbacks:
+            callback(reply)
+        self._notify()
+
+    # ----------------------------------------------------------------
+    # Called by parse_serial_input with each reply key and value it sees
+    #   ("POW", "ON")
+    def reply_received(self, key, value):
+        with self.condition:
+            if self.in_flight is not None and self.in_flight.key == key:
+                metrics.inc("projectionist_serial_replies_matched_total",
+                            device=self.name)
+                self._complete("answered", value)
+
+    # ----------------------------------------------------------------
+    # Called by parse_serial_input with each ">" echo it sees
+    def echo_received(self, frame):
+        with self.condition:
+            if self.in_flight is not None and self.in_flight.key is None \
+                    and frame.lower() == self.in_flight.frame.lower():
+                metrics.inc("projectionist_serial_replies_matched_total",
+                            device=self.name)
+                self._complete("echoed", "")
+
+    # ----------------------------------------------------------------
+    # Called by parse_serial_input when the projector rejects a command
+    #   ("*Block item#", "*Illegal format#")
+    def error_received(self, error):
+        with self.condition:
+            if self.in_flight is not None:
+                metrics.inc("projectionist_serial_commands_refused_total",
+                            device=self.name)
+                self._complete(f'refused with "{error}"')
+
+
+################################################################
+# State cache
+#
+# The last value the projector reported for each attribute ("power",
+# "source", ...), so it only goes out over MQTT when it changes, or
+# when it hasn't been published for heartbeat seconds.  Other code can
+# read it with get() or snapshot() instead of asking the projector.
+
+
+class StateCache:
+    def __init__(self, heartbeat):
+        self.heartbeat = heartbeat
+        self.lock = threading.Lock()
+        self.values = {}
+        self.updated_at = {}
+        self.published_at = {}
+        self.stale = set()
+
+    # ----------------------------------------------------------------
+    # Record a reported value; returns True if it should be published
+    def update(self, attribute, value):
+        with self.lock:
+            now = time.monotonic()
+            changed = self.values.get(attribute) != value
+            self.values[attribute] = value
+            self.updated_at[attribute] = now
+
+            if changed or self.heartbeat is None or \
+                    now - self.published_at.get(attribute, 0) >= self.heartbeat:
+                self.published_at[attribute] = now
+                return True
+            return False
+
+    # ----------------------------------------------------------------
+    # Take on values saved by an earlier run.  Each is stale until the
+    #   projector has reported that attribute itself.  publish_cached_state
+    #   sends them when we connect, so they count as published.
+    def restore(self, values):
+        with self.lock:
+            now = time.monotonic()
+            for attribute, value in values.items():
+                self.values[attribute] = value
+                self.published_at[attribute] = now
+            self.stale = set(values)
+
+    # ----------------------------------------------------------------
+    # Live values for these attributes have come in (or won't); returns
+    #   True if that settled the last restored value waiting for one
+    def confirm(self, *attributes):
+        with self.lock:
+            if self.stale.isdisjoint(attributes):
+                return False
+            self.stale.difference_update(attributes)
+            return not self.stale
+
+    def stale_attributes(self):
+        with self.lock:
+            return sorted(self.stale)
+
+    def get(self, attribute, default=None):
+        with self.lock:
+            return self.values.get(attribute, default)
+
+    # ----------------------------------------------------------------
+    # Only what the projector has said since we started; a restored
+    #   value is for showing, not for deciding what to send it
+    def live(self, attribute, default=None):
+        with self.lock:
+            if attribute in self.stale:
+                return default
+            return self.values.get(attribute, default)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.values)
 
-# Compute the queue wait timeout
-queue_timeout = int(1.1 * int(config["worker"]["delay"]))
-logger.debug(
-    f"using {queue_timeout}s queue timeout at 110% of worker delay ({config['worker']['delay']})"
-)
+
+################################################################
+# Poll schedule
+#
+# When to ask the projector about each polled attribute.  Every one has
+# its own interval (worker.poll, falling back to worker.delay), so the
+# model name can be asked for once a day and the power state every
+# minute.  Right after a command, or after the power state changes, the
+# affected attributes are asked for every poll_fast seconds for
+# poll_fast_for seconds.  While the projector is off, intervals are
+# stretched by poll_off_backoff, and commands marked needs_power in the
+# command table aren't polled at all.  Anything falling due within
+# batch_window seconds of a poll goes out with it, to save a wakeup.
+
+
+class PollSchedule:
+    def __init__(self, commands, worker_config):
+        self.commands = {command.attribute: command for command in commands}
+        self.batch_window = 0.5
+        self.condition = threading.Condition()
+        self.waker = None
+        self.kicked = False
+
+        # Everything is due straight away at startup
+        now = time.monotonic()
+        self.next_due = {attribute: now for attribute in self.commands}
+        self.fast_until = {attribute: 0 for attribute in self.commands}
+        self.configure(worker_config)
+
+    # ----------------------------------------------------------------
+    # Take on the intervals in worker_config, at startup or on a reload.
+    #   Anything that now falls due sooner than it was scheduled for is
+    #   brought forward, and the waiting worker is woken to notice.
+    def configure(self, worker_config):
+        delay = worker_config["delay"]
+        intervals = worker_config.get("poll") or {}
+        with self.condition:
+            now = time.monotonic()
+            self.intervals = {
+                attribute: intervals.get(attribute, delay)
+                for attribute in self.commands}
+            self.fast_interval = worker_config.get("poll_fast", min(5, delay))
+            self.fast_for = worker_config.get("poll_fast_for", 30)
+            self.off_backoff = worker_config.get("poll_off_backoff", 1)
+            for attribute, interval in self.intervals.items():
+                self.next_due[attribute] = min(
+                    self.next_due[attribute], now + interval)
+            self.kicked = True
+            self.condition.notify_all()
+            if self.waker is not None:
+                self.waker()
+
+    # ----------------------------------------------------------------
+    # The interval to wait before asking about an attribute again
+    def interval(self, attribute, now, powered_off):
+        interval = self.intervals[attribute]
+        if now < self.fast_until[attribute]:
+            interval = min(interval, self.fast_interval)
+        elif powered_off:
+            interval *= self.off_backoff
+        return interval
+
+    # ----------------------------------------------------------------
+    # The commands due now, and how long until the next one is due
+    def due(self, powered_off):
+        with self.condition:
+            now = time.monotonic()
+            self.kicked = False
+
+            due = []
+            for attribute, command in self.commands.items():
+                if now + self.batch_window < self.next_due[attribute]:
+                    continue
+                self.next_due[attribute] = now + \
+                    self.interval(attribute, now, powered_off)
+                if powered_off and command.needs_power:
+                    continue
+                due.append(command)
+
+            return due, max(0, min(self.next_due.values()) - now)
+
+    # ----------------------------------------------------------------
+    # Poll these attributes fast for a while, starting now
+    def kick(self, attributes):
+        with self.condition:
+            now = time.monotonic()
+            kicked = [attribute for attribute in attributes
+                      if attribute in self.commands]
+            for attribute in kicked:
+                self.fast_until[attribute] = now + self.fast_for
+                self.next_due[attribute] = min(
+                    self.next_due[attribute], now + self.fast_interval)
+            if kicked:
+                logger.debug(f"poll schedule kicked for {kicked}")
+                self.kicked = True
+                self.condition.notify_all()
+                if self.waker is not None:
+                    self.waker()
+
+    # ----------------------------------------------------------------
+    # Block until the next poll is due or the schedule is kicked
+    def wait(self, timeout):
+        with self.condition:
+            self.condition.wait_for(lambda: self.kicked, timeout=timeout)
+
+
+################################################################
+# Power state
+#
+# The projector takes a while to warm up after "*pow=on#" and to cool
+# down after "*pow=off#", and refuses most commands meanwhile.  So each
+# device tracks where it is: off, warming, on or cooling (None until the
+# projector has said).  A POW=ON report from off starts the warm-up, as
+# does the odd "0.33PUN" frame; the first answer to a needs_power query
+# ends it (or warmup_timeout seconds, if none comes).  POW=OFF from on
+# starts the cool-down, which just lasts cooldown seconds, since the
+# projector says OFF throughout.
+#
+# While warming or cooling, commands are parked rather than queued, and
+# go out in order the moment the projector is ready.  Polls are dropped
+# instead, apart from the power query and, while warming, the probe: one
+# needs_power query, asked every poll_fast seconds to catch the end of
+# the warm-up, instead of the whole poll batch.
+
+POWER_OFF = "off"
+POWER_WARMING = "warming"
+POWER_ON = "on"
+POWER_COOLING = "cooling"
+
+
+class PowerState:
+    def __init__(self, passthrough, warmup_timeout, cooldown):
+        self.passthrough = set(passthrough)
+        self.warmup_timeout = warmup_timeout
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.state = None
+        self.deadline = None
+        self.parked = []
+
+    def in_transition(self):
+        return self.state in (POWER_WARMING, POWER_COOLING)
+
+    # ----------------------------------------------------------------
+    # The state a power report ("ON" or "OFF") moves us to
+    def after_report(self, value):
+        with self.lock:
+            if value == "ON":
+                if self.state is None:
+                    return POWER_ON
+                if self.state in (POWER_OFF, POWER_COOLING):
+                    return POWER_WARMING
+            elif value == "OFF":
+                if self.state is None:
+                    return POWER_OFF
+                if self.state in (POWER_ON, POWER_WARMING):
+                    return POWER_COOLING
+            return self.state
+
+    # ----------------------------------------------------------------
+    # The state a transition has timed out into, or None if it hasn't
+    def expired(self):
+        with self.lock:
+            if self.deadline is None or time.monotonic() < self.deadline:
+                return None
+            return POWER_ON if self.state == POWER_WARMING else POWER_OFF
+
+    # ----------------------------------------------------------------
+    # Move to a new state.  Returns None if that's no change, or the
+    #   commands parked until now if the transition is over.
+    def enter(self, state):
+        with self.lock:
+            if state == self.state:
+                return None
+            self.state = state
+            now = time.monotonic()
+            if state == POWER_WARMING:
+                self.deadline = now + self.warmup_timeout
+            elif state == POWER_COOLING:
+                self.deadline = now + self.cooldown
+            else:
+                self.deadline = None
+            if state in (POWER_WARMING, POWER_COOLING):
+                return []
+            parked, self.parked = self.parked, []
+            return parked
+
+    # ----------------------------------------------------------------
+    # Hold on to a command until the transition is over.  Returns False
+    #   if it can go now; polls are dropped rather than parked.
+    def park(self, cmd, priority, queue_args):
+        with self.lock:
+            if self.state not in (POWER_WARMING, POWER_COOLING) or \
+                    cmd in self.passthrough:
+                return False
+            if priority != PRIORITY_POLL:
+                self.parked.append((cmd, queue_args))
+            return True
+
+    # ----------------------------------------------------------------
+    # Seconds until the transition times out, or None
+    def time_left(self):
+        with self.lock:
+            if self.deadline is None:
+                return None
+            return max(0, self.deadline - time.monotonic())
+
+
+################################################################
+# Calibration
+#
+# device.calibration is a list of "token=value" settings, in the order
+# they go in.  hue, saturation and gain belong to whichever primary
+# color the "primcr=..." before them selected, so each primary's
+# settings are read and written with it selected first.
+#
+# Applying it reads back what the projector has now, then writes only
+# the settings that differ: after a lamp mode reset that's usually a
+# handful rather than all 40.  Every step goes through the device's
+# serialQ and the next one is queued from the callback of the last, so
+# they go out as fast as the projector answers and never more than one
+# at a time.  "force" skips the read back and writes everything.
+
+
+# ----------------------------------------------------------------
+# Split the calibration list into [(primary or None, [(token, value)])]
+def parse_calibration(entries):
+    groups = [(None, [])]
+    for entry in entries:
+        token, _, value = str(entry).partition("=")
+        token, value = token.strip(), value.strip()
+        if token.lower() == "primcr":
+            groups.append((value, []))
+        else:
+            groups[-1][1].append((token, value))
+    return [group for group in groups if group[0] is not None or group[1]]
+
+
+# ----------------------------------------------------------------
+# Does the projector's value match the calibration's?  "*VOL=:0#" and
+#   "2.30" vs "2.3" are why this isn't just a string comparison.
+def same_setting(current, wanted):
+    if current is None:
+        return False
+    current = current.lstrip(":")
+    try:
+        return float(current) == float(wanted)
+    except ValueError:
+        return current.upper() == wanted.upper()
+
+
+class CalibrationJob:
+    def __init__(self, device, entries, force=False):
+        self.device = device
+        self.groups = parse_calibration(entries)
+        self.force = force
+        self.phase = "read"
+        self.steps = collections.deque()
+        self.current = {}
+        self.unreadable = set()
+        self.changed = []
+        self.failed = []
+        self.started = None
+
+    def start(self):
+        self.started = time.monotonic()
+        logger.info(
+            f"calibration for {self.device.mqtt_topic} starting{' (forced)' if self.force else ''}")
+        if not self.force:
+            for primary, settings in self.groups:
+                if primary is not None:
+                    self.steps.append((f"primcr={primary}", primary))
+                for token, value in settings:
+                    self.steps.append((f"{token}=?", (primary, token)))
+        self.next_step()
+
+    # ----------------------------------------------------------------
+    # Queue the next step, moving on to the writes once the read back
+    #   is done and finishing once they are
+    def next_step(self):
+        while not self.steps:
+            if self.phase == "write":
+                self.finish()
+                return
+            self.plan_writes()
+            self.phase = "write"
+
+        frame, target = self.steps.popleft()
+        self.device.queue_command(
+            f"\r*{frame}#\r".encode(),
+            callback=lambda reply: self.step_done(frame, target, reply))
+
+    def step_done(self, frame, target, reply):
+        if self.phase == "read":
+            if isinstance(target, tuple):
+                # A primary we couldn't select leaves its values unknown
+                self.current[target] = \
+                    None if target[0] in self.unreadable else reply
+            elif reply is None:
+                self.unreadable.add(target)
+        elif reply is None:
+            self.failed.append(frame)
+        elif target is not None:
+            self.changed.append(frame)
+        self.next_step()
+
+    def plan_writes(self):
+        for primary, settings in self.groups:
+            writes = [
+                (token, value) for token, value in settings
+                if self.force or not same_setting(
+                    self.current.get((primary, token)), value)]
+            if primary is not None and (writes or self.force):
+                self.steps.append((f"primcr={primary}", None))
+            for token, value in writes:
+                self.steps.append((f"{token}={value}", (primary, token)))
+
+        checked = sum(len(settings) for _, settings in self.groups)
+        logger.info(
+            f"calibration for {self.device.mqtt_topic}: {len(self.steps)} write(s) for {checked} setting(s)")
+
+    def finish(self):
+        self.device.calibration_job = None
+        result = {
+            "checked": sum(len(settings) for _, settings in self.groups),
+            "changed": self.changed,
+            "failed": self.failed,
+            "seconds": round(time.monotonic() - self.started, 2),
+        }
+        logger.info(
+            f"calibration for {self.device.mqtt_topic} done: {result}")
+        mqtt_publish(topic=self.device.mqtt_topic + "/calibration",
+                     payload=json.dumps(result))
+
+
+################################################################
+# Devices
+#
+# Each projector is a Device: one serial port, one topic base, one
+# outbound serial queue (a CommandScheduler), one StateCache and one
+# PollSchedule.  All of them share the single MQTT client and
+# the publishQ.  The top-level "serial_port", "mqtt.topic" and "device"
+# sections are the defaults; an optional "devices" list in the config
+# overrides them per projector.  Without a "devices" list we run just
+# the one projector described by the top-level sections, as before.
+
+
+# Asked about every poll_fast seconds during the warm-up, to find out
+#   when it's over: the first polled command that needs the power on.
+#   Both come from the command table, so main() sets them.
+power_query = None
+power_probe = None
+
+
+class Device:
+    def __init__(self, serial_config, topic_config, device_config):
+        self.serial_port = None
+        self.stream_reader = None
+        self.stream_writer = None
+        self.serial_online = True
+        self.serial_lost_at = None
+        self.serialQ = None
+        self.power = None
+        self.configure(serial_config, topic_config, device_config)
+
+        self.state = StateCache(heartbeat=config["worker"].get("heartbeat"))
+        self.polls = PollSchedule(codec.poll_commands, config["worker"])
+        self.availability_due = 0
+        self.discovery = {}
+        self.diagnostics_rtt = (0.0, 0)
+        self.calibration_job = None
+
+    # ----------------------------------------------------------------
+    # Take on this device's sections of the config, at startup or on a
+    #   reload.  The serial port itself is left alone.
+    def configure(self, serial_config, topic_config, device_config):
+        self.serial_config = serial_config
+        self.topic_config = topic_config
+        self.device_config = device_config
+
+        # topic: <prefix>/[<node_id>/]<object_id>
+        self.mqtt_topic = f"{topic_config['prefix']}/{topic_config['node_id']}/{topic_config['object_id']}"
+        logger.debug(f"MQTT using topic base: {self.mqtt_topic}")
+
+        # LWT := Last will and testament
+        self.availability_topic = self.mqtt_topic + "/LWT"
+        logger.debug(
+            f"MQTT using availability topic: {self.availability_topic}")
+
+        scheduler_settings = dict(
+            reply_timeout=serial_config.get("reply_timeout", 1.0),
+            retries=serial_config.get("retries", 2),
+            command_timeouts=serial_config.get("command_timeouts") or {},
+            max_lane_wait=serial_config.get("max_lane_wait", 5.0),
+        )
+        if self.serialQ is None:
+            self.serialQ = CommandScheduler(
+                name=self.mqtt_topic, **scheduler_settings)
+        else:
+            self.serialQ.name = self.mqtt_topic
+            self.serialQ.configure(**scheduler_settings)
+
+        if self.power is None:
+            self.power = PowerState(
+                passthrough=[power_query, power_probe.query()],
+                warmup_timeout=device_config.get("warmup_timeout", 60),
+                cooldown=device_config.get("cooldown", 60))
+        else:
+            self.power.warmup_timeout = device_config.get("warmup_timeout", 60)
+            self.power.cooldown = device_config.get("cooldown", 60)
+
+    # ----------------------------------------------------------------
+    # Queue a raw command for this device's serial port, or park it if
+    #   the projector is warming up or cooling down
+    def queue_command(self, cmd, timeout=None, coalesce=None,
+                      priority=PRIORITY_INTERACTIVE, callback=None):
+        queue_args = dict(timeout=timeout, coalesce=coalesce,
+                          priority=priority, callback=callback)
+        if self.power.park(cmd, priority, queue_args):
+            logger.debug(
+                f'{self.mqtt_topic} {self.power.state}, {"parked" if priority != PRIORITY_POLL else "dropped"} {cmd!r}')
+            return
+        self.serialQ.put(cmd, **queue_args)
+
+
+# ----------------------------------------------------------------
+# Work out each device's config sections.  Entries in "devices" may
+# carry their own "serial_port", "topic" and "device" sections; any key
+# they leave out is taken from the top-level section of the same name.
+def device_settings(config):
+    device_entries = config.get("devices") or [{}]
+
+    settings = []
+    for entry in device_entries:
+        topic_config = {**config["mqtt"]["topic"], **entry.get("topic", {})}
+        if topic_config["node_id"] == "HOSTNAME":
+            topic_config["node_id"] = platform.node()
+        settings.append(dict(
+            serial_config={**config["serial_port"],
+                           **entry.get("serial_port", {})},
+            topic_config=topic_config,
+            device_config={**config["device"], **entry.get("device", {})},
+        ))
+    return settings
+
+
+# ----------------------------------------------------------------
+# Build the list of devices from the config
+def build_devices(config):
+    return [Device(**settings) for settings in device_settings(config)]
+
+
+################################################################
+# State snapshot
+#
+# The polled attributes (power, source, blank, lamp hours, model) of
+# every device are saved to worker.state_file whenever one changes, and
+# loaded back at startup.  They're published as soon as we connect, so
+# Home Assistant has something to show straight after a restart, with
+# <base>/snapshot saying they're stale until the projector has answered
+# for every one of them.  Until it has for "power", polling and
+# calibration go on as if we didn't know whether it's on.
+
+# worker.state_file, and the attributes saved there; set by main()
+state_file = None
+state_file_lock = threading.Lock()
+snapshot_attributes = []
+snapshot_saved_at = None
+
+
+def save_state_snapshot():
+    if not state_file:
+        return
+    snapshot = {
+        "saved_at": time.time(),
+        "devices": {
+            device.mqtt_topic: {
+                attribute: value
+                for attribute, value in device.state.snapshot().items()
+                if attribute in snapshot_attributes}
+            for device in devices},
+    }
+    with state_file_lock:
+        try:
+            with open(state_file + ".tmp", "w") as f:
+                json.dump(snapshot, f)
+            os.replace(state_file + ".tmp", state_file)
+        except OSError as e:
+            logger.error(f'state snapshot write error path="{state_file}" error="{e}"')
+
+
+def load_state_snapshot():
+    global snapshot_saved_at
+    if not state_file or not os.path.exists(state_file):
+        return
+    try:
+        with open(state_file) as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.error(f'state snapshot read error path="{state_file}" error="{e}"')
+        return
+
+    snapshot_saved_at = snapshot.get("saved_at")
+    for device in devices:
+        values = snapshot.get("devices", {}).get(device.mqtt_topic)
+        if values:
+            device.state.restore(values)
+            logger.info(
+                f"Restored stale state for {device.mqtt_topic}: {values}")
+
+
+# Home Assistant announces itself here when it (re)starts, under the
+#   discovery prefix; set by main()
+#   https://www.home-assistant.io/docs/mqtt/discovery/#discovery-messages-and-availability
+discovery_status_topic = None
 
 ################################################################
 # Attach a handler to the keyboard interrupt (control-C).
@@ -127,51 +1609,105 @@ logger.debug(
 def _signal_handler(signal_number, stack_frame):
     logger.info(
         f"Signal {signal.Signals(signal_number).name} caught, closing down ...")
-    systemd.daemon.notify("STOPPING=1")
+    notify_systemd("STOPPING=1")
+    shutting_down.set()
 
     signal.signal(signal.SIGINT, original_sigint_handler)
     signal.signal(signal.SIGTERM, original_sigterm_handler)
     signal.signal(signal.SIGPIPE, original_sigpipe_handler)
 
-    if serial_port is not None:
-        logger.debug("Closing serial port ...")
-        serial_port.close()
+    for device in devices:
+        if device.serial_port is not None:
+            logger.debug(
+                f"Closing serial port {device.serial_config['name']} ...")
+            device.serial_port.close()
+
+    spool.save()
+
+    if multiplexer_path is not None:
+        try:
+            os.remove(multiplexer_path)
+        except OSError:
+            pass
 
+    # The availability goes straight out rather than through the
+    #   publishQ, which nothing will drain now.  After a clean disconnect
+    #   the broker won't send our will, so this is the only "Offline".
     if client is not None:
         logger.debug("Closing MQTT client ...")
-        publish_availability(False)
+        if client_is_connected:
+            for device in devices:
+                client.publish(device.availability_topic, payload="Offline",
+                               qos=0, retain=True)
         client.loop_stop()
         client.disconnect()
 
     logger.info("Exiting.  You don't have to go home, but you can't stay here.")
+
+    # On the event loop, let async_main return rather than raising
+    #   SystemExit from inside a loop callback
+    if main_task is not None:
+        main_task.cancel()
+        return
     sys.exit(0)
 
 
 # ----------------------------------------------------------------
-# Install SIGINT signal handler ASAP
-logger.debug("Installing signal handlers ...")
+# SIGUSR1 dumps the flight recorder and carries on
+def _dump_signal_handler(signal_number, stack_frame):
+    flight_recorder.dump(f"{signal.Signals(signal_number).name} received")
+
+
+# ----------------------------------------------------------------
+# SIGHUP reloads the config file
+def _reload_signal_handler(signal_number, stack_frame):
+    logger.info(
+        f"Signal {signal.Signals(signal_number).name} caught, reloading ...")
+    reload_config()
+
+
+# ----------------------------------------------------------------
+# Install the signal handlers; main() does this as soon as the config
+#   is loaded
+def install_signal_handlers():
+    global original_sigint_handler, original_sigterm_handler, \
+        original_sigpipe_handler
+    logger.debug("Installing signal handlers ...")
+
+    original_sigint_handler = signal.getsignal(signal.SIGINT)
+    signal.signal(signal.SIGINT, _signal_handler)
 
-original_sigint_handler = signal.getsignal(signal.SIGINT)
-signal.signal(signal.SIGINT, _signal_handler)
+    original_sigterm_handler = signal.getsignal(signal.SIGTERM)
+    signal.signal(signal.SIGTERM, _signal_handler)
 
-original_sigterm_handler = signal.getsignal(signal.SIGTERM)
-signal.signal(signal.SIGTERM, _signal_handler)
+    original_sigpipe_handler = signal.getsignal(signal.SIGPIPE)
+    signal.signal(signal.SIGPIPE, _signal_handler)
 
-original_sigpipe_handler = signal.getsignal(signal.SIGPIPE)
-signal.signal(signal.SIGPIPE, _signal_handler)
+    signal.signal(signal.SIGUSR1, _dump_signal_handler)
+    signal.signal(signal.SIGHUP, _reload_signal_handler)
 
 ################################################################
 # MQTT callbacks and setup
 
+# ----------------------------------------------------------------
+# The /set topic of every writable command in the command table
+def subscription_topics(device):
+    return [f"{device.mqtt_topic}/{attribute}/set"
+            for attribute in codec.writable_attributes + ["calibration"]]
+
+
 # ----------------------------------------------------------------
 # The callback for when the broker responds to our connection request.
 
 
-def on_mqtt_connect(client, userdata, flags, rc):
+def on_mqtt_connect(client, userdata, flags, rc, properties=None):
     global client_is_connected
     if rc == 0:
         logger.info(f'MQTT connect flags="{flags}", result code={rc}')
         client_is_connected = True
+        if metrics.value("projectionist_mqtt_connects_total"):
+            metrics.inc("projectionist_mqtt_reconnects_total")
+        metrics.inc("projectionist_mqtt_connects_total")
     elif rc == 1:
         logger.error(
             f"MQTT connect refused: incorrect protocol version, flags={flags}, result code={rc}"
@@ -212,15 +1748,23 @@ def on_mqtt_connect(client, userdata, flags, rc):
     # Subscribing in on_mqtt_connect() means that if we lose the
     # connection and reconnect then subscriptions will be renewed.
 
-    # Subscribe to the appropriate locations
-    #   If you add more here, be sure to update the "topic.startswith"
-    #   section in on_message function
-    client.subscribe(mqtt_topic + "/power/set")
-    client.subscribe(mqtt_topic + "/source/set")
-    client.subscribe(mqtt_topic + "/blank/set")
+    # Home Assistant's birth message tells us when to resend discovery
+    client.subscribe(discovery_status_topic)
+
+    # Subscribe to the /set topic of every writable command in the
+    #   command table, for every device
+    for device in devices:
+        client.subscribe([(topic, 0) for topic in subscription_topics(device)])
 
-    # Update mqtt availability topic on connect
-    publish_availability(True)
+        # Update mqtt discovery and availability topics on connect
+        publish_device_config(device)
+
+        # The broker doesn't keep state messages, so catch up anyone
+        # who missed them while we were away
+        publish_cached_state(device)
+
+    # Start flushing whatever was spooled while we were away
+    wake_publishq()
 
 
 # ----------------------------------------------------------------
@@ -232,356 +1776,2243 @@ def on_mqtt_connect(client, userdata, flags, rc):
 #   The payload is a binary string (bytes).
 #   qos is an integer quality of service indicator (0,1, or 2)
 #   mid is an integer message ID.
+#
+# Command topics look like <topic base>/<command>/set, so the topic base
+# picks the device and the next level picks the command.
 def on_mqtt_message(client, userdata, msg):
-    if msg.topic.startswith(mqtt_topic):
-        msg_to_cmds(msg.topic.split("/")[3], msg.payload)
+    flight_recorder.record("mqtt<", msg.topic, msg.payload)
+    if msg.topic == discovery_status_topic:
+        logger.info(f'Home Assistant status "{msg.payload}"')
+        if msg.payload == b"online":
+            for device in devices:
+                publish_device_config(device)
+                publish_cached_state(device)
+        return
+
+    device = None
+    if msg.topic.endswith("/set"):
+        topic_base, _, msg_command = msg.topic[:-len("/set")].rpartition("/")
+        device = devices_by_topic.get(topic_base)
+
+    if device is not None:
+        msg_to_cmds(device, msg_command, msg.payload,
+                    callback=response_callback(msg, msg_command))
     else:
         logger.debug(
             f'mqtt msg unknown mid={msg.mid} topic="{msg.topic}" payload="{msg.payload}"'
         )
 
 
+# ----------------------------------------------------------------
+# MQTT 5 request/response: a /set message with a response topic gets
+#   an answer there, carrying its correlation data, as soon as the
+#   projector has answered the command (or refused it, or the scheduler
+#   has given up on it).  Returns the scheduler callback to do that, or
+#   None if nobody asked for an answer.
+#     {"attribute": "power", "ok": true, "value": "ON"}
+#     {"attribute": "power", "ok": false, "error": "refused or unanswered"}
+def response_callback(msg, attribute):
+    # MQTT 3.1.1 messages have no properties at all
+    properties = getattr(msg, "properties", None)
+    response_topic = getattr(properties, "ResponseTopic", None)
+    if not response_topic:
+        return None
+    correlation_data = getattr(properties, "CorrelationData", None)
+    requested_at = time.monotonic()
+
+    def respond(reply):
+        if reply is None:
+            response = {"attribute": attribute, "ok": False,
+                        "error": "refused or unanswered"}
+        else:
+            response = {"attribute": attribute, "ok": True, "value": reply}
+        logger.debug(
+            f'mqtt response topic="{response_topic}" after {1000 * (time.monotonic() - requested_at):.1f}ms: {response}')
+        properties = Properties(PacketTypes.PUBLISH)
+        if correlation_data is not None:
+            properties.CorrelationData = correlation_data
+        mqtt_publish(topic=response_topic, payload=json.dumps(response),
+                     properties=properties)
+
+    return respond
+
+
 # ----------------------------------------------------------------
 # called when the client disconnects from the broker.
-def on_mqtt_disconnect(client, userdata, rc):
+def on_mqtt_disconnect(client, userdata, rc, properties=None):
     global client_is_connected
     logger.debug(f'mqtt disconnect userdata="{userdata}" rc={rc}')
     client_is_connected = False
 
 
+# ----------------------------------------------------------------
+# called when the broker has acknowledged a publish (or, for QoS 0,
+#   when it has been written out)
+def on_mqtt_publish(client, userdata, mid):
+    if spool.acknowledged(mid):
+        wake_publishq()
+
+
 # ----------------------------------------------------------------
 # Handle the details of an mqtt publish
-#   If the publish fails, put the item on the publishQ
-def mqtt_publish(topic, payload, retain=False):
-    publishQ.put((topic, payload, retain), block=True, timeout=queue_timeout)
+#   Hand the item to the publishQ worker.  The queue is unbounded and
+#   anything the broker can't take goes to the spool, so this never
+#   blocks, whoever calls it.  MQTT 5 properties, if any, go on the end.
+def mqtt_publish(topic, payload, retain=False, properties=None):
+    message = (topic, payload, retain, time.monotonic())
+    if properties is not None:
+        message += (properties,)
+    if event_loop is not None:
+        event_loop.call_soon_threadsafe(publishQ.put_nowait, message)
+    else:
+        publishQ.put_nowait(message)
 
 
 # ----------------------------------------------------------------
-# This faux-callback gets called when there's incoming serial input
-def parse_serial_input(input):
-    # Trim stuff from the beginning and end of the input
-    input.strip()
+# Nudge the publishQ worker to look at the spool again
+def wake_publishq():
+    if event_loop is not None:
+        event_loop.call_soon_threadsafe(publishQ.put_nowait, None)
+    else:
+        publishQ.put_nowait(None)
 
-    # Ignore input that's echo'd back from the projector
-    if input.startswith(">"):
-        logger.debug(f"serial echo back: {repr(input)}")
 
-    # Handle weird power-on state message
-    elif input == "0.33PUN":
-        logger.debug(f'serial weird power-on state message: "{repr(input)}"')
-        serialQ.put(b"\r*pow=?#\r")
+# ----------------------------------------------------------------
+# Update the cached state of the device, publishing it to
+#   <topic base>/<attribute> if it changed or the heartbeat is due
+#   A change in power state means everything else is about to change
+#   too, so that speeds up polling for a while.
+def publish_state(device, attribute, value):
+    previous = device.state.get(attribute)
+    if attribute == "power" and previous is not None and previous != value:
+        device.polls.kick(
+            [attribute] + [command.attribute for command in codec.commands
+                           if command.needs_power])
+
+    if device.state.update(attribute, value):
+        mqtt_publish(topic=device.mqtt_topic + "/" + attribute, payload=value)
+    else:
+        logger.debug(f"state {attribute}={value} unchanged, not publishing")
+
+    # The projector won't answer for needs_power attributes while it's
+    #   off, so what we restored for them is as good as we'll get
+    confirmed = [attribute]
+    if attribute == "power" and value != "ON":
+        confirmed += [command.attribute for command in codec.commands
+                      if command.needs_power]
+    if device.state.confirm(*confirmed):
+        publish_snapshot_status(device)
+    if previous != value:
+        api_push({"device": device.topic_config["object_id"],
+                  "attribute": attribute, "value": value})
+        if attribute in snapshot_attributes:
+            save_state_snapshot()
 
-    # Handle various known responses from the projector
-    elif input.startswith("*MODELNAME="):
-        logger.debug(f"serial found MODELNAME={input[11:-1]}")
-        mqtt_publish(topic=mqtt_topic + "/modelname", payload=input[11:-1])
 
-    elif input.startswith("*LTIM="):
-        logger.debug(f"serial found LTIM={input[6:-1]}")
-        mqtt_publish(topic=mqtt_topic + "/lamphour",
-                     payload=input[6:-1].upper())
+# ----------------------------------------------------------------
+# Republish everything in the state cache, e.g. after reconnecting
+def publish_cached_state(device):
+    for attribute, value in device.state.snapshot().items():
+        mqtt_publish(topic=device.mqtt_topic + "/" + attribute, payload=value)
+    publish_snapshot_status(device)
 
-    elif input.startswith("*POW="):
-        logger.debug(f"serial found POW={input[5:-1]}")
-        mqtt_publish(topic=mqtt_topic + "/power", payload=input[5:-1].upper())
 
-    elif input.startswith("*SOUR="):
-        logger.debug(f"serial found SOUR={input[6:-1]}")
-        mqtt_publish(topic=mqtt_topic + "/source", payload=input[6:-1].upper())
+# ----------------------------------------------------------------
+# Say whether the published state is still the restored snapshot
+#   The entities pick this up as attributes (json_attributes_topic).
+def publish_snapshot_status(device):
+    stale = device.state.stale_attributes()
+    status = {"stale": bool(stale)}
+    if stale:
+        status["stale_attributes"] = stale
+        if snapshot_saved_at is not None:
+            status["saved_at"] = time.strftime(
+                "%Y-%m-%dT%H:%M:%S%z", time.localtime(snapshot_saved_at))
+    mqtt_publish(topic=device.mqtt_topic + "/snapshot",
+                 payload=json.dumps(status))
 
-    elif input.startswith("*BLANK="):
-        logger.debug(f"serial found BLANK={input[7:-1]}")
-        mqtt_publish(topic=mqtt_topic + "/blank", payload=input[7:-1].upper())
+
+# ----------------------------------------------------------------
+# This faux-callback gets called when there's incoming serial input
+def parse_serial_input(device, frame):
+    # Ignore input that's echo'd back from the projector, apart from
+    # letting the scheduler know: for bare commands it's the answer
+    if frame.startswith(b">"):
+        logger.debug(f"serial echo back: {repr(frame)}")
+        device.serialQ.echo_received(
+            frame[1:].decode(encoding="ascii", errors="ignore"))
+
+    # Handle weird power-on state message
+    elif frame == b"0.33PUN":
+        logger.debug(f'serial weird power-on state message: "{repr(frame)}"')
+        set_power_state(device, POWER_WARMING)
+        device.queue_command(power_query, coalesce=power_query,
+                             priority=PRIORITY_CONFIRM)
+
+    # Handle known responses from the projector: "*TOKEN=value#", and
+    # let the scheduler know, so the next command can go out straight
+    # away.  Anything else starting "*" is a refusal ("*Block item#").
+    elif frame.startswith(b"*"):
+        token, equals, value = frame[1:].rstrip(b"#").partition(b"=")
+        token = token.strip().upper()
+        value = value.strip().decode(encoding="ascii", errors="ignore")
+        if not equals:
+            logger.debug(f'serial refused "{repr(frame)}"')
+            device.serialQ.error_received(
+                frame.decode(encoding="ascii", errors="ignore"))
+            return
+
+        device.serialQ.reply_received(token.decode(encoding="ascii",
+                                                   errors="ignore"), value)
+        command = codec.by_reply_token.get(token)
+        if command is not None:
+            logger.debug(f"serial found {command.token}={value}")
+            value = command.decode(value)
+            publish_state(device, command.attribute, value)
+            if command.attribute == "power":
+                set_power_state(device, device.power.after_report(value))
+            elif command.needs_power and \
+                    device.power.state == POWER_WARMING:
+                set_power_state(device, POWER_ON)
+        else:
+            metrics.inc("projectionist_serial_unknown_frames_total",
+                        device=device.mqtt_topic)
+            logger.debug(f'serial unknown reply "{repr(frame)}"')
 
     else:
-        logger.debug(f'serial unknown "{repr(input)}"')
+        metrics.inc("projectionist_serial_unknown_frames_total",
+                    device=device.mqtt_topic)
+        logger.debug(f'serial unknown "{repr(frame)}"')
+
+
+# ----------------------------------------------------------------
+# Move a device's power state machine along.  Publishes the new state
+#   to <base>/power_state; once a transition is over, the commands it
+#   parked are queued and everything is polled again.
+def set_power_state(device, state):
+    parked = device.power.enter(state)
+    if parked is None:
+        return
+    logger.info(f"{device.mqtt_topic} power state {state}")
+    publish_state(device, "power_state", state)
+    if state in (POWER_ON, POWER_OFF):
+        if parked:
+            logger.info(
+                f"{device.mqtt_topic} {state}, sending {len(parked)} parked command(s)")
+        for cmd, queue_args in parked:
+            device.serialQ.put(cmd, **queue_args)
+        device.polls.kick(list(device.polls.commands))
+
+
+# ----------------------------------------------------------------
+# A serial port has stopped working (unplugged, most likely).  Leave a
+#   trace behind, hold on to the queued commands and mark the device
+#   offline until the reader manages to reopen the port.  Both the
+#   reader and the writer may notice, so only the first one counts.
+def serial_port_lost(device, message):
+    with device.serialQ.condition:
+        if not device.serial_online:
+            return
+        device.serial_online = False
+        device.serial_lost_at = time.monotonic()
+        device.serialQ.hold()
+    logger.error(message)
+    flight_recorder.dump(f"{device.mqtt_topic}: {message}")
+    publish_availability(device, False)
+    api_push({"device": device.topic_config["object_id"], "online": False})
+
+
+# ----------------------------------------------------------------
+# The reader has the serial port open again: catch up on whatever the
+#   projector did meanwhile and send the commands that were held
+def serial_port_restored(device):
+    device.serial_online = True
+    metrics.inc("projectionist_serial_reconnects_total",
+                device=device.mqtt_topic)
+    logger.warning(
+        f"serial port {device.serial_config['name']} back after {time.monotonic() - device.serial_lost_at:.1f}s")
+    publish_availability(device, True)
+    api_push({"device": device.topic_config["object_id"], "online": True})
+    device.serialQ.release()
+    device.polls.kick(list(device.polls.commands))
+
+
+# ----------------------------------------------------------------
+# Seconds to wait between attempts to reopen a serial port: doubling
+#   from reconnect_min up to reconnect_max, so a port that comes back is
+#   in use again within reconnect_max seconds
+def serial_reconnect_delays(device):
+    delay = device.serial_config.get("reconnect_min", 0.05)
+    while True:
+        yield delay
+        delay = min(2 * delay, device.serial_config.get("reconnect_max", 1.0))
 
 
 # ----------------------------------------------------------------
 # This worker thread handles the outbound serial queue
-def serialq_worker():
-    logger.debug("serialQ worker starting.")
+#   Wait until the scheduler has something to send: a new command once
+#   the last one has been answered, or a retry once it has timed out.
+def serialq_worker(device):
+    logger.debug(f"serialQ worker starting for {device.mqtt_topic}.")
     while True:
-        # Block until there's an object on the queue
-        msg = serialQ.get(block=True, timeout=queue_timeout)
-        logger.debug(f'serialQ worker: qsize={serialQ.qsize()} msg="{msg}"')
-        systemd.daemon.notify("WATCHDOG=1")
+        with device.serialQ.condition:
+            msg, wait = device.serialQ.next_command()
+            while msg is None:
+                supervisor.beat()
+                device.serialQ.condition.wait(
+                    timeout=queue_timeout if wait is None else wait)
+                msg, wait = device.serialQ.next_command()
+
+        logger.debug(
+            f'serialQ worker: topic={device.mqtt_topic} lanes={device.serialQ.lane_sizes()} msg="{msg}"')
+        supervisor.beat()
 
         # Push the object from the queue out the serial port
+        flight_recorder.record("serial>", device.mqtt_topic, msg)
         try:
-            serial_port.write(msg)
+            device.serial_port.write(msg)
         except Exception as e:
-            logger.error(f'serialQ port write error msg="{msg}" error="{e}"')
-            sys.exit(os.EX_IOERR)
+            # Closing the port gets the reader to reopen it
+            serial_port_lost(
+                device, f'serialQ port write error msg="{msg}" error="{e}"')
+            device.serial_port.close()
+
 
-        # Let the queue know that we're successful
-        serialQ.task_done()
-        time.sleep(0.1)  # Pause to let the serial port settle
+# ----------------------------------------------------------------
+# Publish a message from the publishQ, or spool it if we're not
+#   connected (or the spool hasn't been flushed yet)
+def publish_message(message):
+    topic, payload, retain, queued_at = message[:4]
+
+    # A response is only any use to whoever is waiting for it now, so
+    #   it doesn't wait behind the spool, and isn't spooled itself
+    if len(message) > 4:
+        if not client_is_connected:
+            logger.debug(f'publishQ dropping response topic="{topic}", not connected')
+            return
+        flight_recorder.record("mqtt>", topic, payload)
+        client.publish(topic, payload=payload, qos=0, properties=message[4])
+        return
+
+    if not client_is_connected or len(spool):
+        logger.debug(f'publishQ spooling topic="{topic}" ({len(spool)} spooled)')
+        spool.add(message)
+        return
+
+    # QoS 0, so the client takes it or it doesn't: there's nothing to
+    #   wait for
+    flight_recorder.record("mqtt>", topic, payload)
+    result = client.publish(topic, payload=payload, qos=0, retain=retain)
+    if result.rc == mqtt.MQTT_ERR_SUCCESS:
+        logger.debug(f"publishQ worker success mid={result.mid}")
+        metrics.observe("projectionist_publish_wait_seconds",
+                        time.monotonic() - queued_at)
+    else:
+        logger.debug(
+            f"publishQ worker failed mid={result.mid} rc={result.rc}, spooling")
+        metrics.inc("projectionist_publish_failures_total")
+        spool.add(message)
+
+
+# ----------------------------------------------------------------
+# Publish the next batch from the spool at QoS 1, if we're connected
+def flush_spool():
+    if not client_is_connected:
+        return
+    batch = spool.take_batch()
+    for index, message in enumerate(batch):
+        topic, payload, retain, queued_at = message
+        flight_recorder.record("mqtt>", topic, payload)
+        spool.sending()
+        result = client.publish(topic, payload=payload, qos=1, retain=retain)
+        if result.rc != mqtt.MQTT_ERR_SUCCESS:
+            spool.sent(None, message)
+            logger.debug(
+                f"publishQ spool flush failed mid={result.mid} rc={result.rc}")
+            metrics.inc("projectionist_publish_failures_total")
+            spool.put_back(batch[index:])
+            break
+        spool.sent(result.mid, message)
+        metrics.observe("projectionist_publish_wait_seconds",
+                        time.monotonic() - queued_at)
+    if batch:
+        spool.batch_done()
+        logger.debug(f"publishQ flushed {len(batch)} spooled message(s), {len(spool)} to go")
 
 
 # ----------------------------------------------------------------
 # This worker thread handles the outbound publish queue
+#   None on the queue is just a wake-up, to flush the spool.
 def publishq_worker():
     logger.debug("publishQ worker starting.")
+    timeout = queue_timeout
     while True:
-        # Block until there's an object on the queue
-        topic, payload, retain = publishQ.get(
-            block=True, timeout=queue_timeout)
-        logger.debug(
-            f'publishQ worker: qsize={publishQ.qsize()} topic="{topic}" payload="{payload}" retain="{retain}"'
-        )
-        systemd.daemon.notify("WATCHDOG=1")
-
-        # publish the object from the queue
-        result = client.publish(topic, payload=payload, qos=0, retain=retain)
-        if result.rc == 0 and result.is_published():
-            # Let the queue know that we're successful
-            logger.debug(f"publishQ worker success mid={result.mid}")
-            publishQ.task_done()
-        else:
+        try:
+            message = publishQ.get(block=True, timeout=timeout)
+        except queue.Empty:
+            message = None
+        if message is not None:
             logger.debug(
-                f"publishQ worker failed mid={result.mid} rc={result.rc} result.is_published()={result.is_published()}"
+                f'publishQ worker: qsize={publishQ.qsize()} topic="{message[0]}" payload="{message[1]}" retain="{message[2]}"'
             )
-            time.sleep(0.1)  # Don't spin if things go wrong
+            publish_message(message)
+        supervisor.beat()
+        flush_spool()
+        timeout = spool.save_if_due(queue_timeout)
 
 
 # ----------------------------------------------------------------
 # Convert messages into commands for the projector
-def msg_to_cmds(msg_command, msg_payload):
-    logger.debug(f'msg_to_cmds cmd="{msg_command}" payload="{msg_payload}"')
-    if msg_command == "blank":
-        if msg_payload == b"ON":
-            serialQ.put(b"\r*blank=on#\r")
-        elif msg_payload == b"OFF":
-            serialQ.put(b"\r*blank=off#\r")
-        else:
-            serialQ.put(b"\r*blank=?#\r")
+#   callback, if given, is called with the projector's answer, as for
+#   queue_command.  A calibration answers "STARTED" if it did.
+def msg_to_cmds(device, msg_command, msg_payload, callback=None):
+    logger.debug(
+        f'msg_to_cmds topic={device.mqtt_topic} cmd="{msg_command}" payload="{msg_payload}"')
+    if msg_command == "calibration":
+        started = apply_calibration(
+            device, force=msg_payload.strip().lower() == b"force")
+        if callback is not None:
+            callback("STARTED" if started else None)
+        return
+
+    command = codec.by_attribute.get(msg_command)
+    if command is None:
+        logger.debug(f'msg_to_cmds unknown cmd="{msg_command}"')
+        if callback is not None:
+            callback(None)
+        return
+
+    # Only the newest value for a command is worth sending, and a query
+    #   already waiting to go out doesn't need company.  Steps and bare
+    #   commands all go out, however many are waiting.
+    cmd = command.encode(msg_payload)
+    if cmd is not None:
+        device.queue_command(
+            cmd, coalesce=command.attribute
+            if command.absolute(msg_payload) else None,
+            callback=callback)
+        device.polls.kick([command.attribute])
+        return
+
+    # Anything the command doesn't take asks for the current value
+    cmd = command.query()
+    if cmd is not None:
+        device.queue_command(cmd, coalesce=cmd, callback=callback)
+    elif callback is not None:
+        callback(None)
 
-    elif msg_command == "power":
-        if msg_payload == b"ON":
-            serialQ.put(b"\r*pow=on#\r")
-        elif msg_payload == b"OFF":
-            serialQ.put(b"\r*pow=off#\r")
-        else:
-            serialQ.put(b"\r*pow=?#\r")
-
-    elif msg_command == "source":
-        if msg_payload == b"HDMI" or msg_payload == b"HDMI1":
-            serialQ.put(b"\r*sour=hdmi#\r")
-        elif msg_payload == b"HDMI2":
-            serialQ.put(b"\r*sour=hdmi2#\r")
-        elif msg_payload == b"RGB":
-            serialQ.put(b"\r*sour=rgb#\r")
-        elif msg_payload == b"USB":
-            serialQ.put(b"\r*sour=usbreader#\r")
-        else:
-            serialQ.put(b"\r*sour=?#\r")
+
+# ----------------------------------------------------------------
+# Apply device.calibration, unless it's already being applied
+#   The projector refuses picture settings in standby, so don't try.
+#   Returns True if it started.
+def apply_calibration(device, force=False):
+    entries = device.device_config.get("calibration") or []
+    if not entries:
+        logger.warning(f"no calibration configured for {device.mqtt_topic}")
+    elif device.calibration_job is not None:
+        logger.warning(
+            f"calibration for {device.mqtt_topic} already in progress")
+    elif device.state.live("power") != "ON":
+        logger.warning(
+            f"not calibrating {device.mqtt_topic}: projector isn't on")
+    else:
+        device.calibration_job = CalibrationJob(device, entries, force)
+        device.calibration_job.start()
+        return True
+    return False
 
 
 # ----------------------------------------------------------------
 # Update the availability topic of the device
 #   https://www.hivemq.com/blog/mqtt-essentials-part-9-last-will-and-testament/
-def publish_availability(available=True):
+def publish_availability(device, available=True):
     logger.debug(
-        f'publish availability topic="{availability_topic}" available={available}'
+        f'publish availability topic="{device.availability_topic}" available={available}'
     )
     if available:
-        mqtt_publish(topic=availability_topic, payload="Online", retain=False)
+        mqtt_publish(topic=device.availability_topic,
+                     payload="Online", retain=False)
     else:
-        mqtt_publish(topic=availability_topic, payload="Offline", retain=True)
+        mqtt_publish(topic=device.availability_topic,
+                     payload="Offline", retain=True)
 
 
 # ----------------------------------------------------------------
-# Build and publish the configuration for related devices
+# Build the configuration for related devices
 # - Switch for /power
-def publish_switch_config():
-    logger.info("Transmitting JSON to config switch topic")
-
+def build_switch_config(device):
     # <discovery_prefix>/<component>/[<node_id>/]<object_id>/config
     # Best practice for entities with a unique_id is to set <object_id>
     # to unique_id and omit the <node_id>, so ...
     # <discovery_prefix>/<component>/<unique_id>/config
-    unique_id = config["mqtt"]["topic"]["unique_id"] + "_power"
+    unique_id = device.topic_config["unique_id"] + "_power"
     config_topic = f"{config['mqtt']['discovery']['prefix']}/switch/{unique_id}/config"
 
     # Setting up power
     power_switch_config = {
-        "name": config["mqtt"]["topic"]["name"] + " power",
-        "state_topic": mqtt_topic + "/power",
-        "command_topic": mqtt_topic + "/power/set",
+        "name": device.topic_config["name"] + " power",
+        "state_topic": device.mqtt_topic + "/power",
+        "json_attributes_topic": device.mqtt_topic + "/snapshot",
+        "command_topic": device.mqtt_topic + "/power/set",
         "payload_off": "OFF",
         "payload_on": "ON",
-        "availability_topic": mqtt_topic + "/LWT",
+        "availability_topic": device.mqtt_topic + "/LWT",
         "payload_available": "Online",
         "payload_not_available": "Offline",
         "unique_id": unique_id,
         "icon": "mdi:projector",
         "device": {
             "via_device": platform.node(),
-            "manufacturer": config["device"]["manufacturer"],
-            "model": config["device"]["model"],
+            "manufacturer": device.device_config["manufacturer"],
+            "model": device.device_config["model"],
             "identifiers": unique_id,
         },
     }
-    mqtt_publish(
-        topic=config_topic,
-        payload=json.dumps(power_switch_config),
-        retain=True
-    )
+    return config_topic, power_switch_config
 
 
 # ----------------------------------------------------------------
-# Build and publish the configuration for related devices
+# Build the configuration for related devices
 # - Select for /source
-def publish_select_config():
-    logger.info("Transmitting JSON to config select topic")
-
+def build_select_config(device):
     # <discovery_prefix>/<component>/<unique_id>/config
-    unique_id = config["mqtt"]["topic"]["unique_id"] + "_source"
+    unique_id = device.topic_config["unique_id"] + "_source"
     config_topic = f"{config['mqtt']['discovery']['prefix']}/select/{unique_id}/config"
 
     # Setting up source select
     source_select_config = {
-        "name": config["mqtt"]["topic"]["name"] + " input source",
-        "state_topic": mqtt_topic + "/source",
-        "command_topic": mqtt_topic + "/source/set",
+        "name": device.topic_config["name"] + " input source",
+        "state_topic": device.mqtt_topic + "/source",
+        "json_attributes_topic": device.mqtt_topic + "/snapshot",
+        "command_topic": device.mqtt_topic + "/source/set",
         "options": ["HDMI1", "HDMI2", "RGB", "USB"],
-        "availability_topic": mqtt_topic + "/LWT",
+        "availability_topic": device.mqtt_topic + "/LWT",
         "payload_available": "Online",
         "payload_not_available": "Offline",
         "unique_id": unique_id,
         "icon": "mdi:video-input-hdmi",
         "device": {
             "via_device": platform.node(),
-            "manufacturer": config["device"]["manufacturer"],
-            "model": config["device"]["model"],
+            "manufacturer": device.device_config["manufacturer"],
+            "model": device.device_config["model"],
             "identifiers": unique_id,
         },
     }
-    mqtt_publish(
-        topic=config_topic, payload=json.dumps(source_select_config), retain=True
-    )
+    return config_topic, source_select_config
 
 
 # ----------------------------------------------------------------
-# Build and publish the configuration for related devices
+# Build the configuration for related devices
 # - Sensor for /lamphour
-def publish_sensor_config():
-    logger.info("Transmitting JSON to config sensor topic")
-
+def build_sensor_config(device):
     # <discovery_prefix>/<component>/<unique_id>/config
-    unique_id = config["mqtt"]["topic"]["unique_id"] + "_sensor"
+    unique_id = device.topic_config["unique_id"] + "_sensor"
     config_topic = f"{config['mqtt']['discovery']['prefix']}/sensor/{unique_id}/config"
 
     # Setting up source select
     source_select_config = {
-        "name": config["mqtt"]["topic"]["name"] + " hours lamp used",
-        "state_topic": mqtt_topic + "/lamphour",
+        "name": device.topic_config["name"] + " hours lamp used",
+        "state_topic": device.mqtt_topic + "/lamphour",
+        "json_attributes_topic": device.mqtt_topic + "/snapshot",
         "unit_of_measurement": "hours",
-        "availability_topic": mqtt_topic + "/LWT",
+        "availability_topic": device.mqtt_topic + "/LWT",
         "payload_available": "Online",
         "payload_not_available": "Offline",
         "unique_id": unique_id,
         "icon": "mdi:lightbulb",
         "device": {
             "via_device": platform.node(),
-            "manufacturer": config["device"]["manufacturer"],
-            "model": config["device"]["model"],
+            "manufacturer": device.device_config["manufacturer"],
+            "model": device.device_config["model"],
             "identifiers": unique_id,
         },
     }
-    mqtt_publish(
-        topic=config_topic, payload=json.dumps(source_select_config), retain=True
-    )
+    return config_topic, source_select_config
 
 
 # ----------------------------------------------------------------
-# Worker thread to periodically push initial commands onto the serial queue
-def timed_worker():
-    while True:
-        logger.info("timed_worker awakens!")
-        systemd.daemon.notify("WATCHDOG=1")
+# Build the configuration for related devices
+# - Button for /calibration
+def build_button_config(device):
+    # <discovery_prefix>/<component>/<unique_id>/config
+    unique_id = device.topic_config["unique_id"] + "_calibration"
+    config_topic = f"{config['mqtt']['discovery']['prefix']}/button/{unique_id}/config"
+
+    # Setting up calibration button
+    calibration_button_config = {
+        "name": device.topic_config["name"] + " apply calibration",
+        "command_topic": device.mqtt_topic + "/calibration/set",
+        "payload_press": "apply",
+        "entity_category": "config",
+        "availability_topic": device.mqtt_topic + "/LWT",
+        "payload_available": "Online",
+        "payload_not_available": "Offline",
+        "unique_id": unique_id,
+        "icon": "mdi:palette",
+        "device": {
+            "via_device": platform.node(),
+            "manufacturer": device.device_config["manufacturer"],
+            "model": device.device_config["model"],
+            "identifiers": unique_id,
+        },
+    }
+    return config_topic, calibration_button_config
+
+
+# ----------------------------------------------------------------
+# Build the configuration for related devices
+# - Diagnostic sensors for /diagnostics, when metrics.discovery is set
+#   Returns a list of (config_topic, config) rather than just one.
+diagnostic_sensors = (
+    # key, name, unit, state_class, icon
+    ("serial_queue_depth", "serial queue depth", None, "measurement",
+     "mdi:tray-full"),
+    ("serial_round_trip_ms", "serial round trip", "ms", "measurement",
+     "mdi:timer-outline"),
+    ("serial_commands_sent", "serial commands sent", None,
+     "total_increasing", "mdi:counter"),
+    ("serial_unknown_frames", "serial unknown frames", None,
+     "total_increasing", "mdi:help-circle-outline"),
+    ("publish_failures", "MQTT publish failures", None, "total_increasing",
+     "mdi:alert-circle-outline"),
+    ("mqtt_reconnects", "MQTT reconnects", None, "total_increasing",
+     "mdi:lan-disconnect"),
+)
 
-        # Poke the projector into updating its current state
-        serialQ.put(b"\r*modelname=?#\r")
-        serialQ.put(b"\r*ltim=?#\r")
-        serialQ.put(b"\r*pow=?#\r")
-        serialQ.put(b"\r*sour=?#\r")
-        serialQ.put(b"\r*blank=?#\r")
 
-        # Publish the config for the projector
-        publish_switch_config()
-        publish_select_config()
-        publish_sensor_config()
+def build_diagnostic_configs(device):
+    configs = []
+    for key, name, unit, state_class, icon in diagnostic_sensors:
+        unique_id = device.topic_config["unique_id"] + "_" + key
+        config_topic = f"{config['mqtt']['discovery']['prefix']}/sensor/{unique_id}/config"
+        sensor_config = {
+            "name": device.topic_config["name"] + " " + name,
+            "state_topic": device.mqtt_topic + "/diagnostics",
+            "value_template": "{{ value_json." + key + " }}",
+            "state_class": state_class,
+            "entity_category": "diagnostic",
+            "availability_topic": device.mqtt_topic + "/LWT",
+            "payload_available": "Online",
+            "payload_not_available": "Offline",
+            "unique_id": unique_id,
+            "icon": icon,
+            "device": {
+                "via_device": platform.node(),
+                "manufacturer": device.device_config["manufacturer"],
+                "model": device.device_config["model"],
+                "identifiers": unique_id,
+            },
+        }
+        if unit is not None:
+            sensor_config["unit_of_measurement"] = unit
+        configs.append((config_topic, sensor_config))
+    return configs
 
-        # Publish availability
-        publish_availability(True)
 
+# ----------------------------------------------------------------
+# Publish the diagnostic sensors' values as one JSON document.  The
+#   round trip is the mean since the last time this was published.
+def publish_diagnostics(device):
+    rtt_sum, rtt_count = metrics.value(
+        "projectionist_serial_round_trip_seconds", device=device.mqtt_topic)
+    last_sum, last_count = device.diagnostics_rtt
+    device.diagnostics_rtt = (rtt_sum, rtt_count)
+
+    diagnostics = {
+        "serial_queue_depth": device.serialQ.qsize(),
+        "serial_round_trip_ms":
+            round(1000 * (rtt_sum - last_sum) / (rtt_count - last_count), 1)
+            if rtt_count > last_count else None,
+        "serial_commands_sent": metrics.value(
+            "projectionist_serial_commands_sent_total",
+            device=device.mqtt_topic),
+        "serial_unknown_frames": metrics.value(
+            "projectionist_serial_unknown_frames_total",
+            device=device.mqtt_topic),
+        "publish_failures": metrics.value(
+            "projectionist_publish_failures_total"),
+        "mqtt_reconnects": metrics.value(
+            "projectionist_mqtt_reconnects_total"),
+    }
+    mqtt_publish(topic=device.mqtt_topic + "/diagnostics",
+                 payload=json.dumps(diagnostics))
+
+
+# ----------------------------------------------------------------
+# Poke the projector into updating whatever part of its state is due,
+#   and keep the availability topic fresh.  Returns how long to wait
+#   before doing it again.
+def run_poll_cycle(device):
+    expired = device.power.expired()
+    if expired is not None:
+        logger.warning(
+            f"{device.mqtt_topic} power transition timed out, assuming {expired}")
+        set_power_state(device, expired)
+
+    powered_off = device.state.live("power") == "OFF"
+    due, wait = device.polls.due(powered_off)
+    for command in due:
+        device.queue_command(command.query(), coalesce=command.query(),
+                             priority=PRIORITY_POLL)
+    if due and not device.power.in_transition():
         logger.info(
-            f"worker updates queued. Sleeping for {config['worker']['delay']} secs"
-        )
-        time.sleep(config["worker"]["delay"])
+            f"timed_worker for {device.mqtt_topic} queued {[command.token for command in due]}")
+
+    # Only the probe is worth asking during the warm-up
+    if device.power.state == POWER_WARMING:
+        device.queue_command(power_probe.query(),
+                             coalesce=power_probe.query(),
+                             priority=PRIORITY_CONFIRM)
+        wait = min(wait, device.polls.fast_interval)
+    time_left = device.power.time_left()
+    if time_left is not None:
+        wait = min(wait, time_left)
+
+    now = time.monotonic()
+    if now >= device.availability_due:
+        publish_availability(device, device.serial_online)
+        if (config.get("metrics") or {}).get("discovery"):
+            publish_diagnostics(device)
+        device.availability_due = now + config["worker"]["delay"]
+
+    return min(wait, device.availability_due - now)
+
+
+# ----------------------------------------------------------------
+# Serialize the discovery configs for the projector
+#   The payloads only change if the config does, so they're built once
+#   and kept with a hash of their content: {topic: (payload, digest)}
+def build_discovery(device):
+    entities = [build(device) for build in (
+        build_switch_config, build_select_config, build_sensor_config)]
+    if device.device_config.get("calibration"):
+        entities.append(build_button_config(device))
+    if (config.get("metrics") or {}).get("discovery"):
+        entities += build_diagnostic_configs(device)
+
+    discovery = {}
+    for config_topic, entity_config in entities:
+        payload = json.dumps(entity_config)
+        discovery[config_topic] = (
+            payload, hashlib.sha256(payload.encode()).hexdigest())
+    return discovery
+
+
+# ----------------------------------------------------------------
+# Rebuild the discovery configs, publishing the ones whose content
+#   changed (or all of them, if force is set).  Entities that have gone
+#   away get an empty retained config, which removes them from Home
+#   Assistant.
+def refresh_discovery(device, force=False):
+    discovery = build_discovery(device)
+    for config_topic, (payload, digest) in discovery.items():
+        previous = device.discovery.get(config_topic)
+        if force or previous is None or previous[1] != digest:
+            logger.info(f'Transmitting JSON to config topic "{config_topic}"')
+            mqtt_publish(topic=config_topic, payload=payload, retain=True)
+    for config_topic in device.discovery.keys() - discovery.keys():
+        logger.info(f'Removing config topic "{config_topic}"')
+        mqtt_publish(topic=config_topic, payload="", retain=True)
+    device.discovery = discovery
+
+
+# ----------------------------------------------------------------
+# Publish the config and availability for the projector
+#   Called when we (re)connect and when Home Assistant comes online,
+#   not on every poll.
+def publish_device_config(device):
+    for config_topic, (payload, digest) in device.discovery.items():
+        logger.info(f'Transmitting JSON to config topic "{config_topic}"')
+        mqtt_publish(topic=config_topic, payload=payload, retain=True)
+
+    # Publish availability
+    publish_availability(device, device.serial_online)
+
+
+# ----------------------------------------------------------------
+# Worker thread to push poll commands onto the serial queue as they
+#   fall due on the device's poll schedule
+def timed_worker(device):
+    while True:
+        supervisor.beat()
+        wait = run_poll_cycle(device)
+        logger.debug(f"timed_worker sleeping for {wait:.1f} secs")
+        device.polls.wait(wait)
+
+
+# ----------------------------------------------------------------
+# This worker thread reads the serial port of a single device
+#   Take whatever has arrived (waiting for at least a byte), so each
+#   frame is dispatched as soon as its terminator is in.  If the port
+#   fails, it's closed and reopened from here.
+def serial_reader(device):
+    logger.info(f"Entering read loop for {device.serial_config['name']}")
+    framer = SerialFramer()
+    while True:
+        supervisor.beat()
+        port = device.serial_port
+        try:
+            data = port.read(port.in_waiting or 1)
+        except (serial.SerialException, OSError, TypeError) as e:
+            # Closing the port mid-read can leave pyserial reading from
+            #   fd None, hence the TypeError
+            if shutting_down.is_set():
+                return
+            framer = SerialFramer()
+            # A reload swapped the port out from under us
+            if device.serial_port is not port:
+                continue
+            serial_port_lost(
+                device, f'serial port {device.serial_config["name"]} read error error="{e}"')
+            port.close()
+            reconnect_serial_port(device)
+            continue
+        for frame in framer.feed(data):
+            flight_recorder.record("serial<", device.mqtt_topic, frame)
+            parse_serial_input(device, frame)
 
 
 ################################################################
-# Launch the MQTT network client
-logger.debug("Starting MQTT client setup")
-client = mqtt.Client(client_id=platform.node(), clean_session=True)
-client.enable_logger(logger=logger)
+# Local control API
+#
+# An optional HTTP server for control panels on the LAN, so they don't
+# have to go through the broker.  It takes the same commands as the
+# /set topics and answers reads from the state cache, never from the
+# serial line:
+#
+#   GET  /api/devices                       every device, by object_id
+#   GET  /api/devices/<object_id>           its cached state
+#   GET  /api/devices/<object_id>/<attr>    one cached value
+#   POST /api/devices/<object_id>/<attr>    body as for <attr>/set
+#   GET  /api/ws                            WebSocket, see below
+#
+# A WebSocket client gets every device's state when it connects, then
+# {"device", "attribute", "value"} for each change as soon as it's
+# decoded, and {"device", "online"} when a serial port comes and goes.
+# It can send {"device", "attribute", "payload"} to command the
+# projector, or leave out "payload" to get the cached value back.
+#
+# If api.token is set, requests need "Authorization: Bearer <token>",
+# or "?token=<token>" for browsers' WebSockets, which can't send headers.
+# If it isn't, anything that can reach the port can read and command,
+# but POSTs and WebSocket upgrades with an Origin other than our own
+# are turned away, so a web page open on the LAN can't drive the
+# projector through a visitor's browser.
+
+websocket_guid = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+api_clients = set()
+api_clients_lock = threading.Lock()
+
+
+# ----------------------------------------------------------------
+# The device with this object_id, or None
+def api_device(device_id):
+    for device in devices:
+        if device.topic_config["object_id"] == device_id:
+            return device
+    return None
+
+
+def api_device_state(device):
+    return {"device": device.topic_config["object_id"],
+            "online": device.serial_online,
+            "stale": bool(device.state.stale_attributes()),
+            "state": device.state.snapshot()}
 
-# Assign callbacks
-client.on_connect = on_mqtt_connect
-client.on_message = on_mqtt_message
-client.on_disconnect = on_mqtt_disconnect
 
-if config["mqtt"]["useTLS"]:
-    logger.debug("Enabling TLS for MQTT")
-    client.tls_set()
+# ----------------------------------------------------------------
+# One attribute's value; power_state comes from the power state machine
+def api_value(device, attribute):
+    if attribute == "power_state":
+        return device.power.state
+    return device.state.get(attribute)
 
-client.username_pw_set(config["mqtt"]["username"], config["mqtt"]["password"])
 
 # ----------------------------------------------------------------
-# Start a background thread to connect to the MQTT network.
-logger.debug("Starting background thread for MQTT connection")
-client.connect_async(
-    config["mqtt"]["hostname"],
-    port=config["mqtt"]["portnumber"],
-    keepalive=config["mqtt"]["keepalive"],
+# Send a message to every WebSocket client.  Each has its own bounded
+#   queue and writer thread, so a slow client never holds up the serial
+#   reader; one that falls too far behind is dropped.
+def api_push(message):
+    if not api_clients:
+        return
+    text = json.dumps(message)
+    with api_clients_lock:
+        clients = list(api_clients)
+    for websocket in clients:
+        websocket.send(text)
+
+
+# ----------------------------------------------------------------
+# Just enough of RFC 6455 for JSON text messages: no extensions, and
+#   fragmented messages are put back together
+class WebSocket:
+    def __init__(self, handler):
+        self.rfile = handler.rfile
+        self.wfile = handler.wfile
+        self.name = handler.address_string()
+        self.outbox = queue.Queue(maxsize=256)
+        self.closed = False
+
+    def send(self, text, opcode=0x1):
+        data = text.encode() if isinstance(text, str) else text
+        try:
+            self.outbox.put_nowait((opcode, data))
+        except queue.Full:
+            logger.warning(f"api websocket {self.name} too slow, dropping it")
+            self.close()
+
+    def close(self):
+        self.closed = True
+        try:
+            self.outbox.put_nowait((0x8, b""))
+        except queue.Full:
+            pass
+
+    def _write_frame(self, opcode, payload):
+        header = bytes([0x80 | opcode])
+        if len(payload) < 126:
+            header += bytes([len(payload)])
+        elif len(payload) < 1 << 16:
+            header += bytes([126]) + struct.pack("!H", len(payload))
+        else:
+            header += bytes([127]) + struct.pack("!Q", len(payload))
+        self.wfile.write(header + payload)
+        self.wfile.flush()
+
+    # ----------------------------------------------------------------
+    # Runs in its own thread, writing out whatever is sent until the
+    #   connection is closed
+    def writer(self):
+        try:
+            while True:
+                opcode, payload = self.outbox.get()
+                self._write_frame(opcode, payload)
+                if opcode == 0x8:
+                    return
+        except OSError:
+            self.closed = True
+
+    def _read_frame(self):
+        header = self.rfile.read(2)
+        if len(header) < 2:
+            return None, None, None
+        fin, opcode = header[0] & 0x80, header[0] & 0x0F
+        length = header[1] & 0x7F
+        if length == 126:
+            length, = struct.unpack("!H", self.rfile.read(2))
+        elif length == 127:
+            length, = struct.unpack("!Q", self.rfile.read(8))
+        mask = self.rfile.read(4) if header[1] & 0x80 else bytes(4)
+        payload = self.rfile.read(length)
+        if len(payload) < length:
+            return None, None, None
+        return fin, opcode, bytes(
+            byte ^ mask[index % 4] for index, byte in enumerate(payload))
+
+    # ----------------------------------------------------------------
+    # The next text message, or None once the client has gone away
+    def receive(self):
+        message = b""
+        while not self.closed:
+            fin, opcode, payload = self._read_frame()
+            if opcode is None or opcode == 0x8:
+                return None
+            if opcode == 0x9:
+                self.send(payload, opcode=0xA)
+                continue
+            if opcode in (0x0, 0x1, 0x2):
+                message += payload
+                if fin:
+                    return message.decode(errors="replace")
+        return None
+
+
+class ApiRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    # ----------------------------------------------------------------
+    # Check the token, if there is one, and split the path up.  Returns
+    #   None (having answered already) if the request won't do.
+    def route(self):
+        url = urllib.parse.urlsplit(self.path)
+        token = (config.get("api") or {}).get("token")
+        if token:
+            offered = self.headers.get("Authorization", "")
+            offered = offered[len("Bearer "):] if offered.startswith("Bearer ") \
+                else urllib.parse.parse_qs(url.query).get("token", [""])[0]
+            if not hmac.compare_digest(offered, token):
+                self.send_json(401, {"error": "unauthorized"})
+                return None
+        parts = [urllib.parse.unquote(part)
+                 for part in url.path.strip("/").split("/")]
+        if parts[:1] != ["api"]:
+            self.send_json(404, {"error": "not found"})
+            return None
+        return parts[1:]
+
+    # ----------------------------------------------------------------
+    # Without a token, only take commands from pages we served ourselves
+    #   (or from clients that send no Origin at all, i.e. not browsers).
+    #   Returns False (having answered already) if the request won't do.
+    def same_origin(self):
+        origin = self.headers.get("Origin")
+        if not origin or (config.get("api") or {}).get("token"):
+            return True
+        if urllib.parse.urlsplit(origin).netloc.lower() == \
+                self.headers.get("Host", "").lower():
+            return True
+        logger.warning(f'api {self.address_string()} refused, origin="{origin}"')
+        self.send_json(403, {"error": "cross-origin request"})
+        return False
+
+    def do_GET(self):
+        parts = self.route()
+        if parts is None:
+            return
+        if parts == ["ws"]:
+            self.serve_websocket()
+            return
+        if parts == ["devices"]:
+            self.send_json(200, [
+                {"device": device.topic_config["object_id"],
+                 "name": device.topic_config["name"],
+                 "topic": device.mqtt_topic,
+                 "online": device.serial_online}
+                for device in devices])
+            return
+        device = api_device(parts[1]) \
+            if len(parts) in (2, 3) and parts[0] == "devices" else None
+        if device is None:
+            self.send_json(404, {"error": "no such device"})
+        elif len(parts) == 2:
+            self.send_json(200, api_device_state(device))
+        elif parts[2] not in codec.by_attribute and parts[2] != "power_state":
+            self.send_json(404, {"error": "no such attribute"})
+        else:
+            self.send_json(200, {"device": parts[1], "attribute": parts[2],
+                                 "value": api_value(device, parts[2])})
+
+    def do_POST(self):
+        parts = self.route()
+        if parts is None or not self.same_origin():
+            return
+        payload = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        device = api_device(parts[1]) \
+            if len(parts) == 3 and parts[0] == "devices" else None
+        if device is None:
+            self.send_json(404, {"error": "no such device"})
+        elif parts[2] not in codec.by_attribute and parts[2] != "calibration":
+            self.send_json(404, {"error": "no such attribute"})
+        else:
+            msg_to_cmds(device, parts[2], payload.strip())
+            self.send_json(202, {"device": parts[1], "attribute": parts[2],
+                                 "queued": payload.decode(errors="replace")})
+
+    do_PUT = do_POST
+
+    # ----------------------------------------------------------------
+    # Upgrade to a WebSocket and serve it until the client goes away
+    def serve_websocket(self):
+        key = self.headers.get("Sec-WebSocket-Key")
+        if self.headers.get("Upgrade", "").lower() != "websocket" or not key:
+            self.send_json(400, {"error": "expected a WebSocket upgrade"})
+            return
+        if not self.same_origin():
+            return
+        accept = base64.b64encode(hashlib.sha1(
+            (key + websocket_guid).encode()).digest()).decode()
+        self.send_response(101)
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept)
+        self.end_headers()
+        self.wfile.flush()
+        self.close_connection = True
+
+        websocket = WebSocket(self)
+        writer = threading.Thread(target=websocket.writer, daemon=True)
+        writer.start()
+        logger.info(f"api websocket {websocket.name} connected")
+        for device in devices:
+            websocket.send(json.dumps(api_device_state(device)))
+        with api_clients_lock:
+            api_clients.add(websocket)
+        try:
+            while True:
+                text = websocket.receive()
+                if text is None:
+                    break
+                self.websocket_message(websocket, text)
+        except (OSError, ValueError, struct.error) as e:
+            logger.debug(f'api websocket {websocket.name} error="{e}"')
+        finally:
+            with api_clients_lock:
+                api_clients.discard(websocket)
+            websocket.close()
+            writer.join(timeout=1)
+            logger.info(f"api websocket {websocket.name} disconnected")
+
+    def websocket_message(self, websocket, text):
+        try:
+            message = json.loads(text)
+            device = api_device(message["device"])
+            attribute = message["attribute"]
+        except (ValueError, KeyError, TypeError):
+            websocket.send(json.dumps({"error": "bad message"}))
+            return
+        if device is None:
+            websocket.send(json.dumps({"error": "no such device"}))
+        elif "payload" in message:
+            msg_to_cmds(device, attribute, str(message["payload"]).encode())
+        else:
+            websocket.send(json.dumps({
+                "device": message["device"], "attribute": attribute,
+                "value": api_value(device, attribute)}))
+
+    def log_message(self, format, *args):
+        logger.debug(f"api {self.address_string()} {format % args}")
+
+
+def start_api_server():
+    api_config = config.get("api") or {}
+    if not api_config.get("port"):
+        return
+    address = api_config.get("address", "127.0.0.1")
+    # MQTT still works without the API, so a port that's taken isn't
+    #   worth dying for either
+    try:
+        server = http.server.ThreadingHTTPServer(
+            (address, api_config["port"]), ApiRequestHandler)
+    except OSError as e:
+        logger.error(
+            f'api server failed to start on {address}:{api_config["port"]}, carrying on without it: error="{e}"')
+        return
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Serving the control API on http://{address}:{api_config['port']}/api/")
+
+
+################################################################
+# Serial multiplexer
+#
+# Only one process can have a serial port open, so while we're running
+# command-line tools (projection-assistant.py, captures/tk850.sh) can't
+# get at the projector.  With multiplexer.path set, they can go through
+# us instead, over a Unix socket there.  Each line a client sends is a
+# command ("*pow=?#", or just "pow=?"), optionally after the object_id
+# of the device it's for ("tk850_left *pow=?#"; the first device
+# otherwise).  It's queued on that device's serialQ like a /set from
+# MQTT, and its answer comes back as a line of JSON, in the order the
+# commands were sent:
+#     {"command": "*pow=?#", "ok": true, "value": "ON"}
+#     {"command": "*blank=on#", "ok": false, "error": "refused or unanswered"}
+# Clients can send commands back to back without waiting.  The
+# connection is closed once the client has stopped sending and every
+# answer has gone back.  Replies are published to MQTT as usual, so
+# Home Assistant keeps up with whatever the tools change.
+
+multiplexer_path = None
+
+
+class MultiplexerHandler(socketserver.StreamRequestHandler):
+    # ----------------------------------------------------------------
+    # Answer commands in order while another thread reads them in
+    def handle(self):
+        answers = queue.Queue()
+        threading.Thread(target=self.read_commands, args=(answers,),
+                         daemon=True).start()
+        while True:
+            answer = answers.get()
+            if answer is None:
+                return
+            response = answer.get()
+            try:
+                self.wfile.write((json.dumps(response) + "\n").encode())
+            except OSError as e:
+                logger.debug(f'multiplexer client went away error="{e}"')
+                return
+
+    def read_commands(self, answers):
+        try:
+            for line in self.rfile:
+                answers.put(self.submit(
+                    line.decode(encoding="ascii", errors="ignore").strip()))
+        except (OSError, ValueError):
+            pass
+        answers.put(None)
+
+    # ----------------------------------------------------------------
+    # Queue one command line.  Returns where its answer will turn up.
+    def submit(self, line):
+        answer = queue.Queue(maxsize=1)
+        device = devices[0]
+        if line and not line.startswith("*") and " " in line:
+            device_id, line = line.split(None, 1)
+            device = api_device(device_id)
+        body = line.strip("*# \t")
+        command = f"*{body}#"
+        logger.debug(f'multiplexer command "{command}"')
+
+        if device is None:
+            answer.put({"command": command, "ok": False,
+                        "error": "unknown device"})
+        elif not body:
+            answer.put({"command": command, "ok": False,
+                        "error": "empty command"})
+        elif not device.serial_online:
+            answer.put({"command": command, "ok": False,
+                        "error": "serial port offline"})
+        else:
+            def answered(reply):
+                if reply is None:
+                    answer.put({"command": command, "ok": False,
+                                "error": "refused or unanswered"})
+                else:
+                    answer.put({"command": command, "ok": True,
+                                "value": reply})
+            device.queue_command(f"\r{command}\r".encode(),
+                                 callback=answered)
+        return answer
+
+
+def start_multiplexer():
+    global multiplexer_path
+    path = (config.get("multiplexer") or {}).get("path")
+    if not path:
+        return
+
+    # A socket left behind by a run that didn't get to clean up refuses
+    #   connections; anything else at the path isn't ours to remove
+    try:
+        mode = os.stat(path).st_mode
+    except FileNotFoundError:
+        mode = None
+    if mode is not None:
+        if not stat.S_ISSOCK(mode):
+            logger.error(f'multiplexer path "{path}" exists and isn\'t a socket, not sharing the serial line')
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except ConnectionRefusedError:
+            os.remove(path)
+        except OSError as e:
+            logger.error(f'multiplexer socket "{path}" unusable, not sharing the serial line: error="{e}"')
+            return
+        else:
+            logger.error(f'multiplexer socket "{path}" is in use by another process, not sharing the serial line')
+            return
+        finally:
+            probe.close()
+
+    try:
+        server = socketserver.ThreadingUnixStreamServer(path, MultiplexerHandler)
+    except OSError as e:
+        logger.error(f'multiplexer failed to start on "{path}", carrying on without it: error="{e}"')
+        return
+    server.daemon_threads = True
+    os.chmod(path, 0o660)
+    multiplexer_path = path
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f'Sharing the serial line on "{path}"')
+
+
+################################################################
+# Config reload
+#
+# On SIGHUP the config file is read again and compared with the one
+# we're running.  Whatever changed is applied in place: poll intervals,
+# timeouts and retries, topic names (unsubscribing the old /set topics
+# and subscribing the new ones) and discovery (only the entities whose
+# config changed are republished, and ones that went away are removed).
+# A serial port is only reopened if its name changed, and only has its
+# speed set if its baud rate did; the MQTT client only reconnects if the
+# broker address, keepalive or credentials changed.  Everything else
+# carries on as it was, so there's no availability flap.
+#
+# A few settings are only read at startup; changes to them are logged
+# and take effect at the next restart.
+
+restart_settings = (
+    ("worker", "mode"),
+    ("mqtt", "useTLS"),
+    ("mqtt", "protocol"),
+    ("mqtt", "spool"),
+    ("device", "command_table"),
+    ("metrics", "address"),
+    ("metrics", "port"),
+    ("api", "address"),
+    ("api", "port"),
+    ("multiplexer", "path"),
+    ("flight_recorder",),
 )
-client.loop_start()
+
+mqtt_connection_settings = (
+    "hostname", "portnumber", "keepalive", "username", "password")
+
+
+# ----------------------------------------------------------------
+# Look up a nested setting, or None if any level is missing
+def config_setting(settings, path):
+    for key in path:
+        settings = (settings or {}).get(key)
+    return settings
+
+
+# ----------------------------------------------------------------
+# Re-read the config file and apply the differences
+def reload_config():
+    global config, queue_timeout, discovery_status_topic
+    try:
+        with open(args.config_file) as f:
+            new_config = yaml.safe_load(f)
+        settings = device_settings(new_config)
+        new_config["worker"]["delay"]
+    except (OSError, yaml.YAMLError, KeyError, TypeError, AttributeError) as e:
+        logger.error(
+            f'config reload from "{args.config_file}" failed, keeping the old config: error="{e!r}"')
+        return
+
+    if len(settings) != len(devices):
+        logger.warning(
+            f"config reload: {len(settings)} device(s) configured but {len(devices)} running; restart to add or remove devices")
+    settings = settings[:len(devices)]
+
+    topics = [device.mqtt_topic for device in devices[len(settings):]]
+    for entry in settings:
+        topic_config = entry["topic_config"]
+        topics.append(f"{topic_config['prefix']}/{topic_config['node_id']}/{topic_config['object_id']}")
+    if len(set(topics)) != len(topics):
+        logger.error(
+            "config reload: duplicate MQTT topic bases, keeping the old config")
+        return
+
+    for path in restart_settings:
+        if config_setting(config, path) != config_setting(new_config, path):
+            logger.warning(
+                f'config reload: {".".join(path)} changed, restart to apply it')
+
+    logger.info(f'Configuration reloaded from "{args.config_file}"')
+    old_config, config = config, new_config
+
+    queue_timeout = int(1.1 * int(config["worker"]["delay"]))
+
+    # Home Assistant's status topic moves with the discovery prefix
+    new_status_topic = f"{config['mqtt']['discovery']['prefix']}/status"
+    if new_status_topic != discovery_status_topic:
+        if client_is_connected:
+            client.unsubscribe(discovery_status_topic)
+            client.subscribe(new_status_topic)
+        discovery_status_topic = new_status_topic
+
+    for device, entry in zip(devices, settings):
+        reload_device(device, entry)
+
+    devices_by_topic.clear()
+    devices_by_topic.update((device.mqtt_topic, device) for device in devices)
+    save_state_snapshot()
+
+    if any(old_config["mqtt"].get(key) != config["mqtt"].get(key)
+           for key in mqtt_connection_settings):
+        reconnect_mqtt()
+
+
+# ----------------------------------------------------------------
+# Apply a device's reloaded config sections
+def reload_device(device, entry):
+    old_topic = device.mqtt_topic
+    old_availability_topic = device.availability_topic
+    old_subscriptions = subscription_topics(device)
+    old_serial_config = device.serial_config
+
+    device.configure(**entry)
+    device.state.heartbeat = config["worker"].get("heartbeat")
+    device.polls.configure(config["worker"])
+
+    # Move the /set subscriptions to the new topic base
+    if device.mqtt_topic != old_topic:
+        logger.info(
+            f'config reload: topic base "{old_topic}" is now "{device.mqtt_topic}"')
+        if client_is_connected:
+            client.unsubscribe(old_subscriptions)
+            client.subscribe(
+                [(topic, 0) for topic in subscription_topics(device)])
+        mqtt_publish(topic=old_availability_topic, payload="", retain=True)
+        publish_availability(device, device.serial_online)
+        publish_cached_state(device)
+
+    refresh_discovery(device)
+
+    # A different port may well have a different projector on the end
+    #   of it, so ask it about everything straight away
+    if device.serial_config["name"] != old_serial_config["name"]:
+        reopen_serial_port(device, old_serial_config)
+        device.polls.kick(list(device.polls.commands))
+    elif device.serial_config["baud"] != old_serial_config["baud"]:
+        logger.info(
+            f"config reload: {device.serial_config['name']} now at {device.serial_config['baud']} baud")
+        device.serial_port.baudrate = device.serial_config["baud"]
+
+
+# ----------------------------------------------------------------
+# Move a device over to a newly configured serial port.  The new port
+#   is opened before the old one is closed, so if it won't open the
+#   device carries on with the old one.
+def reopen_serial_port(device, old_serial_config):
+    logger.info(
+        f"config reload: moving {device.mqtt_topic} from {old_serial_config['name']} to {device.serial_config['name']}")
+    if worker_mode == "asyncio":
+        event_loop.create_task(
+            async_reopen_serial_port(device, old_serial_config))
+        return
+
+    old_port = device.serial_port
+    try:
+        open_serial_port(device)
+    except (serial.SerialException, OSError) as e:
+        keep_serial_port(device, old_serial_config, e)
+        return
+    device.serial_port.reset_input_buffer()
+    old_port.close()
+
+
+async def async_reopen_serial_port(device, old_serial_config):
+    old_stream_writer = device.stream_writer
+    try:
+        await async_open_serial_port(device)
+    except (serial.SerialException, OSError) as e:
+        keep_serial_port(device, old_serial_config, e)
+        return
+    old_stream_writer.close()
+
+
+def keep_serial_port(device, old_serial_config, error):
+    logger.error(
+        f'config reload: serial port {device.serial_config["name"]} failed to open, keeping {old_serial_config["name"]}: error="{error}"')
+    device.serial_config = {**device.serial_config,
+                            "name": old_serial_config["name"],
+                            "baud": old_serial_config["baud"]}
+
+
+# ----------------------------------------------------------------
+# Reconnect to the broker with the reloaded address and credentials.
+#   Anything published meanwhile goes to the spool.
+def reconnect_mqtt():
+    logger.info(
+        f'config reload: reconnecting to MQTT broker {config["mqtt"]["hostname"]}:{config["mqtt"]["portnumber"]}')
+    client.disconnect()
+    if worker_mode != "asyncio":
+        client.loop_stop()
+    client.username_pw_set(
+        config["mqtt"]["username"], config["mqtt"]["password"])
+    client.connect_async(
+        config["mqtt"]["hostname"],
+        port=config["mqtt"]["portnumber"],
+        keepalive=config["mqtt"]["keepalive"],
+    )
+    # In asyncio mode async_mqtt_worker notices the connection has gone
+    #   and reconnects to the new address by itself
+    if worker_mode != "asyncio":
+        client.loop_start()
+
 
 ################################################################
-# Connect to the serial device
+# asyncio mode
+#
+# The same work as the threads above, but as coroutines on one event
+# loop: serial reads and writes go through pyserial-asyncio, and the
+# MQTT client's socket is watched by the loop instead of by paho's own
+# network thread.  Nothing wakes up unless there's something to do.
+
+# ----------------------------------------------------------------
+# Drive the paho client from the event loop using its socket callbacks
+#   https://github.com/eclipse/paho.mqtt.python/blob/master/examples/loop_asyncio.py
+#   Connecting happens in a thread of its own (async_mqtt_connect), so
+#   the callbacks it triggers are passed over to the loop.
+class AsyncioMqttHelper:
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.client = client
+        self.client.on_socket_open = self.on_socket_open
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = self.on_socket_register_write
+        self.client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def _on_loop(self, callback, *args):
+        if threading.get_ident() == self.loop_thread:
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def on_socket_open(self, client, userdata, sock):
+        logger.debug("asyncio mqtt socket opened")
+        self._on_loop(self.loop.add_reader, sock, client.loop_read)
+
+    def on_socket_close(self, client, userdata, sock):
+        logger.debug("asyncio mqtt socket closed")
+        self._on_loop(self.loop.remove_reader, sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self._on_loop(self.loop.add_writer, sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self._on_loop(self.loop.remove_writer, sock)
+
+
+# ----------------------------------------------------------------
+# Connect (or reconnect) the MQTT client without blocking the loop.
+#   The connect, and any TLS handshake, can block for a long time with
+#   the broker unreachable, so it runs in a thread of its own: a daemon
+#   thread, unlike an executor's, so it can't hold up shutdown.
+async def async_mqtt_connect():
+    connected = event_loop.create_future()
+
+    def settle(error):
+        if connected.done():
+            return
+        if error is None:
+            connected.set_result(None)
+        else:
+            connected.set_exception(error)
+
+    def connect():
+        try:
+            client.reconnect()
+        except Exception as e:
+            event_loop.call_soon_threadsafe(settle, e)
+        else:
+            event_loop.call_soon_threadsafe(settle, None)
+
+    threading.Thread(target=connect, name="mqtt_connect", daemon=True).start()
+    await connected
+
+
+# ----------------------------------------------------------------
+# Coroutine to keep the MQTT connection up and run paho's housekeeping
+#   (keepalive pings, retries).  loop_misc() fails once the connection
+#   drops, at which point we reconnect after a short pause.
+async def async_mqtt_worker():
+    logger.debug("asyncio MQTT worker starting.")
+    while True:
+        supervisor.beat()
+        try:
+            await async_mqtt_connect()
+        except Exception as e:
+            logger.error(f"asyncio MQTT connect failed error=\"{e}\"")
+            await asyncio.sleep(1)
+            continue
+
+        while client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            supervisor.beat()
+            await asyncio.sleep(1)
+
+        logger.debug("asyncio MQTT connection lost, reconnecting")
+        await asyncio.sleep(1)
+
+
+# ----------------------------------------------------------------
+# Coroutine to read the serial port of a single device
+async def async_serial_reader(device):
+    logger.info(f"Entering read loop for {device.serial_config['name']}")
+    framer = SerialFramer()
+    while True:
+        supervisor.beat()
+        stream_reader = device.stream_reader
+        try:
+            data = await asyncio.wait_for(
+                stream_reader.read(1024), timeout=queue_timeout)
+            error = "closed"
+        except asyncio.TimeoutError:
+            continue
+        except (serial.SerialException, OSError) as e:
+            data, error = b"", e
+        if not data:
+            framer = SerialFramer()
+            # A reload swapped the port out from under us
+            if device.stream_reader is not stream_reader:
+                continue
+            serial_port_lost(
+                device, f'serial port {device.serial_config["name"]} read error error="{error}"')
+            device.stream_writer.close()
+            await async_reconnect_serial_port(device)
+            continue
+        for frame in framer.feed(data):
+            flight_recorder.record("serial<", device.mqtt_topic, frame)
+            parse_serial_input(device, frame)
+
+
+# ----------------------------------------------------------------
+# Coroutine to drain the outbound serial queue of a single device
+#   The scheduler wakes us through an event rather than its condition,
+#   since the reader runs on the same loop.
+async def async_serialq_worker(device):
+    logger.debug(f"serialQ worker starting for {device.mqtt_topic}.")
+    wakeup = asyncio.Event()
+    device.serialQ.waker = lambda: event_loop.call_soon_threadsafe(wakeup.set)
+    while True:
+        supervisor.beat()
+        wakeup.clear()
+        msg, wait = device.serialQ.next_command()
+        if msg is None:
+            try:
+                await asyncio.wait_for(
+                    wakeup.wait(),
+                    timeout=queue_timeout if wait is None else wait)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        logger.debug(
+            f'serialQ worker: topic={device.mqtt_topic} lanes={device.serialQ.lane_sizes()} msg="{msg}"')
+
+        # Push the object from the queue out the serial port
+        flight_recorder.record("serial>", device.mqtt_topic, msg)
+        try:
+            device.stream_writer.write(msg)
+            await device.stream_writer.drain()
+        except Exception as e:
+            # Closing the port gets the reader to reopen it
+            serial_port_lost(
+                device, f'serialQ port write error msg="{msg}" error="{e}"')
+            device.stream_writer.close()
+
+
+# ----------------------------------------------------------------
+# Coroutine to drain the outbound publish queue
+#   The client only queues packets here and the loop writes them out
+#   once the socket is writable, so nothing in here waits on the network.
+async def async_publishq_worker():
+    logger.debug("publishQ worker starting.")
+    timeout = queue_timeout
+    while True:
+        try:
+            message = await asyncio.wait_for(
+                publishQ.get(), timeout=timeout)
+        except asyncio.TimeoutError:
+            message = None
+        if message is not None:
+            logger.debug(
+                f'publishQ worker: qsize={publishQ.qsize()} topic="{message[0]}" payload="{message[1]}" retain="{message[2]}"'
+            )
+            publish_message(message)
+        supervisor.beat()
+        flush_spool()
+        timeout = spool.save_if_due(queue_timeout)
+
+
+# ----------------------------------------------------------------
+# Coroutine to push poll commands onto the serial queue as they fall due
+async def async_timed_worker(device):
+    kicked = asyncio.Event()
+    device.polls.waker = lambda: event_loop.call_soon_threadsafe(kicked.set)
+    while True:
+        supervisor.beat()
+        kicked.clear()
+        wait = run_poll_cycle(device)
+        logger.debug(f"timed_worker sleeping for {wait:.1f} secs")
+        try:
+            await asyncio.wait_for(kicked.wait(), timeout=wait)
+        except asyncio.TimeoutError:
+            pass
+
+
+# ----------------------------------------------------------------
+# Open a device's serial port as a pair of streams
 #  Needs 9600 8N1 with all flow control disabled
-serial_port = serial.Serial(
-    config["serial_port"]["name"],
-    baudrate=config["serial_port"]["baud"],
-    bytesize=8,
-    parity="N",
-    stopbits=1,
-    timeout=1.0,
-    xonxoff=False,
-    rtscts=False,
-    dsrdtr=False,
-)
+async def async_open_serial_port(device):
+    device.stream_reader, device.stream_writer = \
+        await serial_asyncio.open_serial_connection(
+            url=device.serial_config["name"],
+            baudrate=device.serial_config["baud"],
+            bytesize=8,
+            parity="N",
+            stopbits=1,
+            xonxoff=False,
+            rtscts=False,
+            dsrdtr=False,
+        )
+    device.serial_port = device.stream_writer.transport.serial
+
+
+# ----------------------------------------------------------------
+# Keep trying to reopen a failed serial port until it comes back
+async def async_reconnect_serial_port(device):
+    for delay in serial_reconnect_delays(device):
+        supervisor.beat()
+        await asyncio.sleep(delay)
+        try:
+            await async_open_serial_port(device)
+        except (serial.SerialException, OSError) as e:
+            logger.debug(
+                f'serial port {device.serial_config["name"]} still gone error="{e}"')
+            continue
+        device.serial_port.reset_input_buffer()
+        serial_port_restored(device)
+        return
+
+
+# ----------------------------------------------------------------
+# Set up the queues, serial ports and MQTT client on the event loop, then
+#   run every worker as a supervised task.
+async def async_main():
+    global event_loop, publishQ, main_task
+    event_loop = asyncio.get_running_loop()
+    main_task = asyncio.current_task()
+
+    # Route the signals through the loop so the handler runs between tasks
+    for signal_number in (signal.SIGINT, signal.SIGTERM, signal.SIGPIPE):
+        event_loop.add_signal_handler(
+            signal_number, _signal_handler, signal_number, None)
+    event_loop.add_signal_handler(
+        signal.SIGUSR1, _dump_signal_handler, signal.SIGUSR1, None)
+    event_loop.add_signal_handler(
+        signal.SIGHUP, _reload_signal_handler, signal.SIGHUP, None)
+
+    publishQ = asyncio.Queue()
+    AsyncioMqttHelper(event_loop, client)
+    client.connect_async(
+        config["mqtt"]["hostname"],
+        port=config["mqtt"]["portnumber"],
+        keepalive=config["mqtt"]["keepalive"],
+    )
+
+    # Connect to the serial devices
+    for device in devices:
+        await async_open_serial_port(device)
+
+    supervisor.start("mqtt_worker", async_mqtt_worker)
+    supervisor.start("publishq_worker", async_publishq_worker)
+    for device in devices:
+        supervisor.start(f"timed_worker {device.mqtt_topic}",
+                         async_timed_worker, device)
+        supervisor.start(f"serialq_worker {device.mqtt_topic}",
+                         async_serialq_worker, device)
+        supervisor.start(f"serial_reader {device.mqtt_topic}",
+                         async_serial_reader, device)
+
+    start_metrics_server()
+    start_api_server()
+    start_multiplexer()
+
+    # Tell systemd that our service is ready
+    notify_systemd("READY=1")
+
+    # Until _signal_handler cancels us
+    try:
+        while True:
+            supervisor.check()
+            await asyncio.sleep(supervisor_interval)
+    except asyncio.CancelledError:
+        pass
+
+
+################################################################
+# Threaded mode
+#
+# A blocking read loop per serial port, plus worker threads for the
+# serial and publish queues and the periodic poll.
+
+# ----------------------------------------------------------------
+# Open a device's serial port
+#  Needs 9600 8N1 with all flow control disabled
+def open_serial_port(device):
+    device.serial_port = serial.Serial(
+        device.serial_config["name"],
+        baudrate=device.serial_config["baud"],
+        bytesize=8,
+        parity="N",
+        stopbits=1,
+        timeout=1.0,
+        xonxoff=False,
+        rtscts=False,
+        dsrdtr=False,
+    )
+
+
+# ----------------------------------------------------------------
+# Keep trying to reopen a failed serial port until it comes back
+def reconnect_serial_port(device):
+    for delay in serial_reconnect_delays(device):
+        supervisor.beat()
+        if shutting_down.wait(delay):
+            return
+        try:
+            open_serial_port(device)
+        except (serial.SerialException, OSError) as e:
+            logger.debug(
+                f'serial port {device.serial_config["name"]} still gone error="{e}"')
+            continue
+        device.serial_port.reset_input_buffer()
+        serial_port_restored(device)
+        return
+
+
+def run_threaded():
+    # ----------------------------------------------------------------
+    # Start a background thread to connect to the MQTT network.
+    logger.debug("Starting background thread for MQTT connection")
+    client.connect_async(
+        config["mqtt"]["hostname"],
+        port=config["mqtt"]["portnumber"],
+        keepalive=config["mqtt"]["keepalive"],
+    )
+    client.loop_start()
+
+    # ----------------------------------------------------------------
+    # Connect to the serial devices
+    for device in devices:
+        open_serial_port(device)
+
+    # ----------------------------------------------------------------
+    # Rather than waiting a fixed second for things to wake up, check
+    #   they have: the ports are open (and emptied of anything left over
+    #   from before).  The broker isn't waited for; until it lets us in,
+    #   the spool holds on to our messages.
+    for device in devices:
+        if not device.serial_port.is_open:
+            logger.error(
+                f"serial port {device.serial_config['name']} didn't open")
+            sys.exit(os.EX_IOERR)
+        device.serial_port.reset_input_buffer()
+
+    # Start the per-device threads: one to periodically push initial
+    # commands onto the serial queue, one to drain that queue and one to
+    # read the serial port.  The publish queue has a single worker.
+    for device in devices:
+        supervisor.start(f"timed_worker {device.mqtt_topic}",
+                         timed_worker, device)
+        supervisor.start(f"serialq_worker {device.mqtt_topic}",
+                         serialq_worker, device)
+        supervisor.start(f"serial_reader {device.mqtt_topic}",
+                         serial_reader, device)
+    supervisor.start("publishq_worker", publishq_worker)
+    start_metrics_server()
+    start_api_server()
+    start_multiplexer()
+
+    # Tell systemd that our service is ready
+    notify_systemd("READY=1")
+
+    # The worker threads do everything from here; the main thread keeps
+    #   an eye on them and runs the signal handlers.
+    while True:
+        supervisor.check()
+        time.sleep(supervisor_interval)
+
 
 ################################################################
-# wait briefly for the system to complete waking up
-time.sleep(1)
+# ProjectorClient
+#
+# The serial side of the daemon, without the daemon: one open serial
+# session, a codec and a state cache, for scripts that want to talk to
+# the projector themselves.  Commands go through a CommandScheduler
+# just as they do on serialQ, so replies are matched, retried and timed
+# out the same way, and a batch of queries goes out back to back over
+# the one open port rather than a port open (and settle) per question.
+# Every method has an async_ twin for use on an event loop: open the
+# session with open() (or "with") for the blocking ones, async_open()
+# (or "async with") for the async ones.  Nothing is published; values
+# are returned, and kept in client.state.
+#
+#     with projectionist.ProjectorClient("/dev/ttyUSB0") as projector:
+#         projector.power_on()
+#         projector.query_many(["source", "blank"])
+
+
+class ProjectorClient:
+    def __init__(self, port, baud=9600, command_table="commands.yaml",
+                 reply_timeout=1.0, retries=2, command_timeouts=None):
+        self.port = port
+        self.baud = baud
+        self.codec = load_codec(command_table)
+        self.state = StateCache(heartbeat=None)
+        self.framer = SerialFramer()
+        self.queue = CommandScheduler(
+            name=port, reply_timeout=reply_timeout, retries=retries,
+            command_timeouts=command_timeouts or {}, max_lane_wait=5.0)
+        self.serial_port = None
+        self.stream_reader = None
+        self.stream_writer = None
+
+    # ----------------------------------------------------------------
+    # Open and close the serial session
+    def open(self):
+        self.serial_port = serial.Serial(
+            self.port,
+            baudrate=self.baud,
+            bytesize=8,
+            parity="N",
+            stopbits=1,
+            timeout=0.05,
+            xonxoff=False,
+            rtscts=False,
+            dsrdtr=False,
+        )
+        self.serial_port.reset_input_buffer()
+        return self
+
+    async def async_open(self):
+        self.stream_reader, self.stream_writer = \
+            await serial_asyncio.open_serial_connection(
+                url=self.port,
+                baudrate=self.baud,
+                bytesize=8,
+                parity="N",
+                stopbits=1,
+                xonxoff=False,
+                rtscts=False,
+                dsrdtr=False,
+            )
+        self.serial_port = self.stream_writer.transport.serial
+        self.serial_port.reset_input_buffer()
+        return self
+
+    def close(self):
+        if self.stream_writer is not None:
+            self.stream_writer.close()
+        elif self.serial_port is not None:
+            self.serial_port.close()
+        self.serial_port = self.stream_reader = self.stream_writer = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    async def __aenter__(self):
+        return await self.async_open()
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    # ----------------------------------------------------------------
+    # Queue raw commands.  Returns the list their answers go into, in
+    #   order, and the set of indexes still waiting for one.
+    def _queue_all(self, cmds):
+        answers = [None] * len(cmds)
+        outstanding = set(range(len(cmds)))
+        for index, cmd in enumerate(cmds):
+            def answered(reply, index=index):
+                answers[index] = reply
+                outstanding.discard(index)
+            self.queue.put(cmd, callback=answered)
+        return answers, outstanding
+
+    # ----------------------------------------------------------------
+    # Split what came off the port into frames and hand them to the
+    #   scheduler, as parse_serial_input does for a device
+    def _received(self, data):
+        for frame in self.framer.feed(data):
+            if frame.startswith(b">"):
+                self.queue.echo_received(
+                    frame[1:].decode(encoding="ascii", errors="ignore"))
+            elif frame.startswith(b"*"):
+                token, equals, value = frame[1:].rstrip(b"#").partition(b"=")
+                token = token.strip().upper()
+                value = value.strip().decode(encoding="ascii", errors="ignore")
+                if not equals:
+                    self.queue.error_received(
+                        frame.decode(encoding="ascii", errors="ignore"))
+                    continue
+                command = self.codec.by_reply_token.get(token)
+                if command is not None:
+                    self.state.update(command.attribute, command.decode(value))
+                self.queue.reply_received(
+                    token.decode(encoding="ascii", errors="ignore"), value)
+            else:
+                logger.debug(f'{self.port} ignoring "{repr(frame)}"')
+
+    # ----------------------------------------------------------------
+    # Send raw commands ("\r*pow=?#\r"), each as soon as the one before
+    #   has been answered.  Returns their answers in order: the reply's
+    #   value, "" for an echoed bare command, None if refused or never
+    #   answered.
+    def exchange(self, cmds):
+        answers, outstanding = self._queue_all(cmds)
+        while outstanding:
+            cmd, _ = self.queue.next_command()
+            if cmd is not None:
+                self.serial_port.write(cmd)
+                continue
+            self._received(
+                self.serial_port.read(self.serial_port.in_waiting or 1))
+        return answers
+
+    async def async_exchange(self, cmds):
+        answers, outstanding = self._queue_all(cmds)
+        while outstanding:
+            cmd, wait = self.queue.next_command()
+            if cmd is not None:
+                self.stream_writer.write(cmd)
+                continue
+            try:
+                data = await asyncio.wait_for(
+                    self.stream_reader.read(1024), timeout=wait)
+            except asyncio.TimeoutError:
+                continue
+            if not data:
+                raise serial.SerialException(f"{self.port} closed")
+            self._received(data)
+        return answers
+
+    # ----------------------------------------------------------------
+    # The commands to send, and what to make of the answers
+    def _command(self, attribute):
+        command = self.codec.by_attribute.get(attribute)
+        if command is None:
+            raise ValueError(f'unknown attribute "{attribute}"')
+        return command
+
+    def _queries(self, attributes):
+        queries = []
+        for attribute in attributes:
+            query = self._command(attribute).query()
+            if query is None:
+                raise ValueError(f'"{attribute}" can\'t be queried')
+            queries.append(query)
+        return queries
+
+    def _setting(self, attribute, payload):
+        cmd = self._command(attribute).encode(str(payload).encode())
+        if cmd is None:
+            raise ValueError(f'"{payload}" isn\'t a value {attribute} takes')
+        return cmd
+
+    def _decoded(self, attributes, answers):
+        return {
+            attribute: None if answer is None
+            else self.codec.by_attribute[attribute].decode(answer)
+            for attribute, answer in zip(attributes, answers)}
+
+    # The polled attributes worth asking for, given the power state
+    def _state_attributes(self):
+        powered_off = self.state.get("power") != "ON"
+        return [command.attribute for command in self.codec.poll_commands
+                if command.attribute != "power" and
+                not (powered_off and command.needs_power)]
+
+    # ----------------------------------------------------------------
+    # Ask for several attributes in one go.  Returns {attribute: value},
+    #   with None for any the projector didn't answer.
+    def query_many(self, attributes):
+        return self._decoded(attributes,
+                             self.exchange(self._queries(attributes)))
+
+    async def async_query_many(self, attributes):
+        return self._decoded(attributes,
+                             await self.async_exchange(self._queries(attributes)))
+
+    # ----------------------------------------------------------------
+    # Set an attribute from an MQTT-style payload ("ON", "HDMI2", "+").
+    #   Returns the projector's answer, or None if it refused.
+    def set(self, attribute, payload):
+        return self._decoded(
+            [attribute], self.exchange([self._setting(attribute, payload)]))[attribute]
+
+    async def async_set(self, attribute, payload):
+        return self._decoded(
+            [attribute],
+            await self.async_exchange([self._setting(attribute, payload)]))[attribute]
+
+    def power_on(self):
+        return self.set("power", "ON")
+
+    def power_off(self):
+        return self.set("power", "OFF")
+
+    async def async_power_on(self):
+        return await self.async_set("power", "ON")
+
+    async def async_power_off(self):
+        return await self.async_set("power", "OFF")
+
+    # ----------------------------------------------------------------
+    # Ask for everything the daemon polls (just what the projector
+    #   answers in standby, if it's off) and return the state cache
+    def get_state(self):
+        self.query_many(["power"])
+        self.query_many(self._state_attributes())
+        return self.state.snapshot()
+
+    async def async_get_state(self):
+        await self.async_query_many(["power"])
+        await self.async_query_many(self._state_attributes())
+        return self.state.snapshot()
+
+
+################################################################
+# Startup
+#
+# What it takes to get the daemon going, in order: the command line,
+# logging, the config and everything set up from it, the devices and
+# their saved state, the signal handlers and the MQTT client.  Then the
+# workers start, threaded or on the event loop.
+
+# ----------------------------------------------------------------
+# Parse CLI arguments
+def parse_cli_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-f",
+        "--config-file",
+        default="config.yaml",
+        help="load configuration from CONFIG_FILE",
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="store_true",
+        help="output additional information"
+    )
+    return parser.parse_args()
+
+
+# ----------------------------------------------------------------
+# Setup logger to systemd or STDOUT
+def setup_logging(verbose):
+    logger.propagate = False
+
+    # how much output?
+    if verbose:
+        logLevel = logging.DEBUG
+    else:
+        logLevel = logging.WARNING
+    logger.setLevel(logLevel)
+
+    # Send all logging messages to the journal
+    import systemd.journal
+    logging.root.addHandler(systemd.journal.JournalHandler())
+    logger.addHandler(systemd.journal.JournalHandler())
+
+
+# ----------------------------------------------------------------
+# Load config from file, and set up what depends on it
+def load_config(config_file):
+    global config, queue_timeout, worker_mode, codec, flight_recorder, \
+        spool, power_query, power_probe, state_file, snapshot_attributes, \
+        discovery_status_topic
+
+    with open(config_file) as f:
+        config = yaml.safe_load(f)
 
-# Start thread to periodically push initial commands onto the serial queue
-threading.Thread(target=timed_worker, daemon=True).start()
-threading.Thread(target=serialq_worker, daemon=True).start()
-threading.Thread(target=publishq_worker, daemon=True).start()
+    logger.info(f'Configuration loaded from "{config_file}": {config}')
 
-# Start the event loop
-logger.info(f"Entering event loop for {config['serial_port']['name']}")
+    # Compute the queue wait timeout
+    queue_timeout = int(1.1 * int(config["worker"]["delay"]))
+    logger.debug(
+        f"using {queue_timeout}s queue timeout at 110% of worker delay ({config['worker']['delay']})"
+    )
+
+    # Pick the I/O core: "threaded" (the default) runs a blocking read
+    # loop and worker threads, "asyncio" runs everything on one event
+    # loop.
+    worker_mode = config["worker"].get("mode", "threaded")
+    if worker_mode not in ("threaded", "asyncio"):
+        logger.error(f'unknown worker mode "{worker_mode}"')
+        sys.exit(os.EX_CONFIG)
+    logger.debug(f"using {worker_mode} worker mode")
+
+    codec = load_codec(config["device"].get("command_table", "commands.yaml"))
+    power_query = codec.by_attribute["power"].query()
+    power_probe = next(command for command in codec.poll_commands
+                       if command.needs_power)
+
+    flight_recorder_config = config.get("flight_recorder") or {}
+    flight_recorder = FlightRecorder(
+        size=flight_recorder_config.get("size", 2000),
+        path=flight_recorder_config.get(
+            "path", "/var/tmp/projectionist-flight-%Y%m%dT%H%M%S.log"),
+    )
+
+    spool_config = config["mqtt"].get("spool") or {}
+    spool = PublishSpool(
+        limit=spool_config.get("limit", 1000),
+        path=spool_config.get("path"),
+        batch_size=spool_config.get("batch", 20),
+    )
+
+    state_file = config["worker"].get("state_file")
+    snapshot_attributes = [command.attribute
+                           for command in codec.poll_commands]
+    discovery_status_topic = f"{config['mqtt']['discovery']['prefix']}/status"
+
+
+# ----------------------------------------------------------------
+# Build the devices, refusing two with the same topic base
+def setup_devices():
+    global devices
+    devices = build_devices(config)
+    for device in devices:
+        if device.mqtt_topic in devices_by_topic:
+            logger.error(f'duplicate MQTT topic base "{device.mqtt_topic}"')
+            sys.exit(os.EX_CONFIG)
+        devices_by_topic[device.mqtt_topic] = device
+    logger.info(f"Configured {len(devices)} device(s)")
+
+
+# ----------------------------------------------------------------
+# Launch the MQTT network client
+def setup_mqtt_client():
+    global client
+    logger.debug("Starting MQTT client setup")
+    # MQTT 5 gets us request/response on the /set topics; the session
+    #   starts clean either way
+    if config["mqtt"].get("protocol") == 5:
+        logger.debug("Using MQTT 5")
+        client = mqtt.Client(client_id=platform.node(), protocol=mqtt.MQTTv5)
+    else:
+        client = mqtt.Client(client_id=platform.node(), clean_session=True)
+    client.enable_logger(logger=logger)
 
-# Tell systemd that our service is ready
-systemd.daemon.notify("READY=1")
+    # Assign callbacks
+    client.on_connect = on_mqtt_connect
+    client.on_message = on_mqtt_message
+    client.on_disconnect = on_mqtt_disconnect
+    client.on_publish = on_mqtt_publish
 
-while True:
-    input = serial_port.readline().decode(encoding="ascii", errors="ignore").rstrip()
-    if len(input) != 0:
-        systemd.daemon.notify("WATCHDOG=1")
-        parse_serial_input(input)
+    if config["mqtt"]["useTLS"]:
+        logger.debug("Enabling TLS for MQTT")
+        client.tls_set()
+
+    client.username_pw_set(config["mqtt"]["username"], config["mqtt"]["password"])
+
+
+def main():
+    global args
+    args = parse_cli_arguments()
+    setup_logging(args.verbose)
+
+    logger.info(
+        "Projectionist v1.1.2 - Heading into the booth ... It's aliiive!"
+    )
+
+    load_config(args.config_file)
+    setup_devices()
+    load_state_snapshot()
+
+    # Install the signal handlers ASAP
+    install_signal_handlers()
+
+    # Serialize the discovery configs once, up front
+    for device in devices:
+        device.discovery = build_discovery(device)
+
+    setup_mqtt_client()
+
+    if worker_mode == "asyncio":
+        asyncio.run(async_main())
+    else:
+        run_threaded()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import projectionist  # noqa: E402
+
+projectionist.codec = projectionist.load_codec("commands.yaml")
+
+
+class Polls:
+    def kick(self, attributes):
+        pass
+
+
+class Device:
+    """ Just enough of a device for msg_to_cmds, queueing straight onto a
+    CommandScheduler """
+
+    mqtt_topic = "test"
+
+    def __init__(self):
+        self.polls = Polls()
+        self.scheduler = projectionist.CommandScheduler(
+            name="test", reply_timeout=1.0, retries=0, command_timeouts={},
+            max_lane_wait=5.0)
+
+    def queue_command(self, cmd, **queue_args):
+        self.scheduler.put(cmd, **queue_args)
+
+
+def send_all(device, messages):
+    """ Queue every (attribute, payload) before any goes out, then play
+    the projector, answering each command as it's written.  Returns the
+    frames written, in order. """
+
+    for attribute, payload in messages:
+        projectionist.msg_to_cmds(device, attribute, payload)
+    sent = []
+    while True:
+        cmd, _ = device.scheduler.next_command()
+        if cmd is None:
+            return sent
+        frame = cmd.strip().decode()
+        sent.append(frame)
+        token, equals, value = frame.strip("*#").partition("=")
+        if equals:
+            device.scheduler.reply_received(token.upper(), value)
+        else:
+            device.scheduler.echo_received(frame)
+
+
+def test_steps_are_all_sent():
+    sent = send_all(Device(), [("volume", b"+")] * 5)
+    assert sent == ["*vol=+#"] * 5
+
+
+def test_navigation_is_all_sent():
+    sent = send_all(Device(), [("navigate", b"UP"), ("navigate", b"UP"),
+                               ("navigate", b"LEFT"), ("navigate", b"ENTER")])
+    assert sent == ["*up#", "*up#", "*left#", "*enter#"]
+
+
+def test_absolute_values_coalesce():
+    sent = send_all(Device(), [("volume", b"+"), ("volume", b"10"),
+                               ("volume", b"-"), ("volume", b"12"),
+                               ("source", b"HDMI1"), ("source", b"HDMI2")])
+    assert sent == ["*vol=+#", "*vol=12#", "*vol=-#", "*sour=hdmi2#"]